@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+"""Requests parsed per second: RequestParser against the old line-based parser.
+
+    python benchmarks/bench_parser.py [-n REQUESTS] [--pipeline DEPTH]
+"""
+import argparse
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.parser import RequestParser  # noqa: E402
+
+REQUEST = (
+    b'GET /httptest/wikipedia_russia_files/load.css?debug=false&lang=ru HTTP/1.1\r\n'
+    b'Host: localhost:8080\r\n'
+    b'User-Agent: Mozilla/5.0 (X11; Linux x86_64; rv:109.0) Gecko/20100101 Firefox/115.0\r\n'
+    b'Accept: text/css,*/*;q=0.1\r\n'
+    b'Accept-Language: ru-RU,ru;q=0.8,en-US;q=0.5,en;q=0.3\r\n'
+    b'Accept-Encoding: gzip, deflate, br\r\n'
+    b'Connection: keep-alive\r\n'
+    b'Referer: http://localhost:8080/httptest/wikipedia_russia.html\r\n'
+    b'If-Modified-Since: Tue, 15 Nov 1994 12:45:26 GMT\r\n'
+    b'\r\n'
+)
+
+
+def legacy_parse(rfile):
+    """CustomHTTPHandler.parse_request/parse_headers as of the baseline.
+
+    It only ever read the request line, so the headers stay unparsed and
+    pipelined requests cannot be told apart.
+    """
+    raw_request_line = rfile.readline(65537)
+    request_lines = raw_request_line.decode().split('\r\n')
+    words = request_lines[0].split()
+    method, path, version = words
+    headers = {}
+    for line in raw_request_line.decode().split('\r\n')[1:]:
+        if not line:
+            continue
+        key, value = line.split(':')
+        headers[key] = value.strip()
+    return method, path, version, headers
+
+
+def legacy_parse_with_headers(rfile):
+    """The baseline parser fixed to consume header lines, http.server style."""
+    method, path, version, headers = legacy_parse(rfile)
+    while True:
+        line = rfile.readline(65537)
+        if line in (b'\r\n', b'\n', b''):
+            break
+        key, value = line.decode('latin-1').split(':', 1)
+        headers[key] = value.strip()
+    return method, path, version, headers
+
+
+def run_legacy(parse, n, depth):
+    data = REQUEST * depth
+    start = time.perf_counter()
+    for _ in range(n // depth):
+        rfile = io.BufferedReader(io.BytesIO(data))
+        for _ in range(depth):
+            parse(rfile)
+    return time.perf_counter() - start
+
+
+def bench_legacy(n, depth):
+    return run_legacy(legacy_parse, n, 1)
+
+
+def bench_legacy_headers(n, depth):
+    return run_legacy(legacy_parse_with_headers, n, depth)
+
+
+def bench_incremental(n, depth):
+    data = REQUEST * depth
+    parser = RequestParser()
+    start = time.perf_counter()
+    for _ in range(n // depth):
+        parser.feed(data)
+        while parser.next_request() is not None:
+            pass
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', type=int, default=200000, help='Requests to parse [default: 200000]')
+    parser.add_argument('--pipeline', type=int, default=1, metavar='DEPTH',
+                        help='Requests per received buffer [default: 1]')
+    args = parser.parse_args()
+    n = args.n - args.n % args.pipeline
+    benches = [
+        ('legacy (request line only, no pipelining)', bench_legacy),
+        ('legacy + header lines', bench_legacy_headers),
+        ('incremental', bench_incremental),
+    ]
+    for name, bench in benches:
+        elapsed = bench(n, args.pipeline)
+        print(f'{name:42} {n / elapsed:10.0f} req/s  {elapsed * 1e6 / n:6.2f} us/req')
+
+
+if __name__ == '__main__':
+    main()
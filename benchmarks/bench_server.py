@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+"""Throughput and latency of httpd.py under concurrent load on loopback.
+
+    python benchmarks/bench_server.py [-w WORKERS] [-c CONNECTIONS] [-d SECONDS]
+                                      [--mode keepalive|close] [--json FILE]
+
+Starts httpd.py serving the repository root on a free loopback port,
+then several client processes, each running CONNECTIONS / PROCESSES
+asyncio connections that request files of the httptest/ tree in turn,
+either many requests per connection (keepalive) or a new connection per
+request (close). Reports requests/s, bytes/s and latency percentiles;
+--json saves them with the commit and settings for comparison.
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODES = ('keepalive', 'close')
+PATHS = (
+    '/httptest/dir2/',
+    '/httptest/dir2/page.html',
+    '/httptest/splash.css',
+    '/httptest/wikipedia_russia.html',
+    '/httptest/pic_ask.gif',
+    '/httptest/jquery-1.9.1.js',
+)
+STARTUP_TIMEOUT = 10
+READ_SIZE = 64 * 1024
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(port, workers, engine, server_args):
+    command = [sys.executable, os.path.join(ROOT, 'httpd.py'), '-w', str(workers), '--bind', '127.0.0.1',
+               '--engine', engine, '--no-access-log', *server_args, str(port)]
+    process = subprocess.Popen(command, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'httpd.py exited with code {process.returncode}')
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('httpd.py did not start listening')
+
+
+def stop_server(process):
+    process.send_signal(signal.SIGTERM)
+    try:
+        process.wait(STARTUP_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+async def read_response(reader, buffer: bytearray):
+    """Read one response; returns (status, bytes received, whether the server closes)."""
+    while True:
+        end = buffer.find(b'\r\n\r\n')
+        if end >= 0:
+            break
+        data = await reader.read(READ_SIZE)
+        if not data:
+            raise ConnectionError('connection closed before the response headers')
+        buffer += data
+    head = bytes(buffer[:end]).decode('latin-1')
+    status = int(head.split(None, 2)[1])
+    length = 0
+    close = False
+    for line in head.split('\r\n')[1:]:
+        name, _, value = line.partition(':')
+        name = name.lower()
+        if name == 'content-length':
+            length = int(value)
+        elif name == 'connection':
+            close = value.strip().lower() == 'close'
+    size = end + 4 + length
+    while len(buffer) < size:
+        data = await reader.read(READ_SIZE)
+        if not data:
+            raise ConnectionError('connection closed before the end of the body')
+        buffer += data
+    del buffer[:size]
+    return status, size, close
+
+
+async def run_connection(port, requests, deadline, stats):
+    latencies, counters = stats
+    i = 0
+    while time.monotonic() < deadline:
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        except OSError:
+            counters['errors'] += 1
+            await asyncio.sleep(0.01)
+            continue
+        buffer = bytearray()
+        try:
+            while time.monotonic() < deadline:
+                start = time.perf_counter()
+                writer.write(requests[i % len(requests)])
+                i += 1
+                status, size, close = await read_response(reader, buffer)
+                latencies.append(time.perf_counter() - start)
+                counters['bytes'] += size
+                counters['requests'] += 1
+                if status >= 400:
+                    counters['errors'] += 1
+                if close:
+                    break
+        except (OSError, ValueError, IndexError):
+            counters['errors'] += 1
+        finally:
+            writer.close()
+
+
+def run_client(port, connections, keepalive, duration, results):
+    connection = b'keep-alive' if keepalive else b'close'
+    requests = [b'GET %s HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: %s\r\n\r\n' % (path.encode(), connection)
+                for path in PATHS]
+    latencies = []
+    counters = {'requests': 0, 'errors': 0, 'bytes': 0}
+
+    async def main():
+        deadline = time.monotonic() + duration
+        await asyncio.gather(*(run_connection(port, requests[i:] + requests[:i], deadline, (latencies, counters))
+                               for i in range(connections)))
+
+    asyncio.run(main())
+    results.put((latencies, counters))
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def run(port, mode, connections, processes, duration):
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    per_process = [connections // processes + (i < connections % processes) for i in range(processes)]
+    clients = [context.Process(target=run_client, args=(port, n, mode == 'keepalive', duration, results))
+               for n in per_process if n]
+    started = time.perf_counter()
+    for client in clients:
+        client.start()
+    latencies = []
+    totals = {'requests': 0, 'errors': 0, 'bytes': 0}
+    for _ in clients:
+        client_latencies, counters = results.get()
+        latencies.extend(client_latencies)
+        for key, value in counters.items():
+            totals[key] += value
+    for client in clients:
+        client.join()
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        'mode': mode,
+        'connections': connections,
+        'duration': round(elapsed, 3),
+        'requests': totals['requests'],
+        'errors': totals['errors'],
+        'requests_per_sec': round(totals['requests'] / elapsed, 1),
+        'bytes_per_sec': round(totals['bytes'] / elapsed),
+        'latency_ms': {
+            'p50': round(percentile(latencies, 0.50) * 1000, 3),
+            'p99': round(percentile(latencies, 0.99) * 1000, 3),
+            'p999': round(percentile(latencies, 0.999) * 1000, 3),
+            'max': round((latencies[-1] if latencies else 0.0) * 1000, 3),
+        },
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-w', '--workers', type=int, default=2, help='httpd.py workers [default: 2]')
+    parser.add_argument('-e', '--engine', default='thread', help='httpd.py engine [default: thread]')
+    parser.add_argument('-c', '--connections', type=int, default=64,
+                        help='Concurrent client connections [default: 64]')
+    parser.add_argument('-p', '--processes', type=int, default=max((os.cpu_count() or 2) // 2, 1),
+                        help='Client processes sharing the connections [default: half the CPUs]')
+    parser.add_argument('-d', '--duration', type=float, default=10, help='Seconds per mode [default: 10]')
+    parser.add_argument('--mode', choices=MODES, action='append',
+                        help='Connection handling to measure, may be repeated [default: both]')
+    parser.add_argument('--port', type=int, default=0, help='Server port [default: a free one]')
+    parser.add_argument('--server-arg', action='append', default=[], metavar='ARG',
+                        help='Extra httpd.py argument, may be repeated')
+    parser.add_argument('--json', metavar='FILE', help='Write the results to FILE as JSON')
+    args = parser.parse_args()
+
+    port = args.port or free_port()
+    server = start_server(port, args.workers, args.engine, args.server_arg)
+    try:
+        results = []
+        for mode in args.mode or MODES:
+            result = run(port, mode, args.connections, args.processes, args.duration)
+            results.append(result)
+            latency = result['latency_ms']
+            print(f"{mode:10} {result['requests_per_sec']:10.0f} req/s {result['bytes_per_sec'] / 2 ** 20:8.1f} MiB/s"
+                  f"  p50 {latency['p50']:7.2f} ms  p99 {latency['p99']:7.2f} ms  p999 {latency['p999']:7.2f} ms"
+                  f"  errors {result['errors']}")
+    finally:
+        stop_server(server)
+
+    if args.json:
+        report = {
+            'commit': git_commit(),
+            'date': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+            'settings': {'workers': args.workers, 'engine': args.engine, 'connections': args.connections,
+                         'processes': args.processes, 'duration': args.duration,
+                         'server_args': args.server_arg, 'paths': PATHS},
+            'results': results,
+        }
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+            f.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,42 +1,336 @@
 import os
+import logging
 import multiprocessing
 import argparse
-from src.server import Server, CustomHTTPHandler
-
-def start_server(address, workers):
-    servers = []
-    try:
-        for worker in range(workers):
-            server = Server(address, CustomHTTPHandler)
-            p = multiprocessing.Process(target=server.serve_forever)
-            servers.append(p)
-            p.start()
-        for proc in servers:
-            proc.join()
-    except KeyboardInterrupt:
-        for process in servers:
-            if not process:
-                continue
-            pid = process.pid
-            print(pid)
+import signal
+import time
+from src.server import (Server, CustomHTTPHandler, KEEPALIVE_TIMEOUT, MAX_KEEPALIVE_REQUESTS,
+                        MAX_IDLE_CONNECTIONS, MAX_THREADS, MAX_QUEUED_CONNECTIONS, LISTEN_BACKLOG, RETRY_AFTER,
+                        WRITE_TIMEOUT, MIN_TRANSFER_RATE, MAX_CONNECTIONS_PER_IP, SHUTDOWN_TIMEOUT,
+                        parse_cache_control)
+from src.async_server import AsyncServer, AsyncHTTPHandler
+from src.access_log import AccessLog, FORMATS as ACCESS_LOG_FORMATS
+from src.metrics import Metrics
+from src.preload import walk, read_manifest
+from src.ratelimit import RateLimiter, parse_rule as parse_rate_limit, DEFAULT_TABLE_SIZE as DEFAULT_RATE_LIMIT_TABLE
+from src.proxy import (Route, Upstream, parse_route, DEFAULT_CONNECT_TIMEOUT, DEFAULT_UPSTREAM_TIMEOUT,
+                       DEFAULT_MAX_UPSTREAM_CONNECTIONS)
+from src.mime import MimeTypes, parse_override
+from src.parser import MAX_BODY_SIZE
+from src.cache import (DEFAULT_CACHE_SIZE, DEFAULT_MAX_FILE_SIZE, DEFAULT_PATH_CACHE_ENTRIES,
+                       DEFAULT_COMPRESS_CACHE_SIZE, DEFAULT_COMPRESS_MAX_FILE_SIZE, DEFAULT_MMAP_CACHE_SIZE,
+                       DEFAULT_MMAP_MAX_FILE_SIZE)
+
+ENGINES = {
+    'thread': (Server, CustomHTTPHandler),
+    'async': (AsyncServer, AsyncHTTPHandler),
+}
+SUPERVISE_INTERVAL = 0.5
+
+
+class Master:
+    """Prefork supervisor.
+
+    The listening socket is bound once here and inherited by the forked
+    workers, or with reuse_port every worker binds its own SO_REUSEPORT
+    socket and the kernel balances accepts between them. Dead workers are
+    respawned; SIGHUP starts a fresh set of workers and lets the old ones
+    finish their in-flight requests before exiting, for at most the
+    server's shutdown_timeout. SIGUSR1 is passed on to the workers so that
+    they reopen their access logs. Each worker counts into its own slot of
+    the server's Metrics, a respawned worker takes over the slot of the
+    one it replaces.
+    """
+
+    def __init__(self, server, workers, reuse_port=False):
+        self.server = server
+        self.workers = workers
+        self.reuse_port = reuse_port
+        self.processes = []
+        self._retiring = []
+        self._context = multiprocessing.get_context('fork')
+        self._reload = False
+        self._stop = False
+
+    def run(self):
+        signal.signal(signal.SIGHUP, self._on_reload)
+        signal.signal(signal.SIGUSR1, self._on_reopen_logs)
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        self._spawn_workers()
+        try:
+            while not self._stop:
+                time.sleep(SUPERVISE_INTERVAL)
+                if self._reload:
+                    self._reload = False
+                    self.reload()
+                self._supervise()
+        finally:
+            self._stop_workers(self.processes + self._retiring)
+            self.server.close()
+
+    def reload(self):
+        logging.info('Reloading workers')
+        self._retiring.extend(self.processes)
+        self._spawn_workers()
+        for process in self._retiring:
             process.terminate()
-            print('rewrwe')
+
+    def _supervise(self):
+        for i, process in enumerate(self.processes):
+            if not process.is_alive():
+                logging.error(f'Worker {process.pid} exited with code {process.exitcode}, respawning')
+                process.join()
+                self._release_slot(process)
+                self.processes[i] = self._spawn(process.slot)
+        for process in [p for p in self._retiring if not p.is_alive()]:
+            process.join()
+            self._release_slot(process)
+            self._retiring.remove(process)
+
+    def _spawn_workers(self):
+        self.processes = []
+        for _ in range(self.workers):
+            # One by one, so that each worker gets a different metrics slot
+            self.processes.append(self._spawn())
+
+    def _spawn(self, slot=None):
+        if slot is None:
+            slot = self._free_slot()
+        process = self._context.Process(target=self._run_worker, args=(slot,), daemon=True)
+        process.start()
+        process.slot = slot
+        return process
+
+    def _free_slot(self):
+        """Metrics slot not used by any running worker, or None."""
+        metrics = self.server.metrics
+        if not metrics:
+            return None
+        used = {process.slot for process in self.processes + self._retiring}
+        for slot in range(metrics.slots):
+            if slot not in used:
+                return slot
+        logging.warning('No free metrics slot, the new worker is not counted')
+        return None
+
+    def _release_slot(self, process):
+        if self.server.metrics and process.slot is not None:
+            self.server.metrics.release(process.slot)
+
+    def _run_worker(self, slot):
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.server.shutdown())
+        if slot is not None:
+            self.server.metrics.attach(slot)
+        elif self.server.metrics:
+            # Not counted rather than counting into another worker's slot
+            self.server.metrics.detach()
+        if self.server.access_log:
+            signal.signal(signal.SIGUSR1, lambda signum, frame: self.server.access_log.reopen())
+        else:
+            signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+        if self.reuse_port:
+            self.server.connect()
+        self.server.serve_forever()
+
+    def _stop_workers(self, processes):
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        deadline = time.monotonic() + self.server.shutdown_timeout
+        for process in processes:
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                process.kill()
+                process.join()
+
+    def _on_reload(self, signum, frame):
+        self._reload = True
+
+    def _on_reopen_logs(self, signum, frame):
+        for process in self.processes + self._retiring:
+            if process.pid:
+                os.kill(process.pid, signal.SIGUSR1)
+
+    def _on_stop(self, signum, frame):
+        self._stop = True
+
+
+def start_server(address, workers, engine='thread', reuse_port=False, preload=None, **server_options):
+    server_class, handler_class = ENGINES[engine]
+    server = server_class(address, handler_class, connect_now=not reuse_port, reuse_port=reuse_port,
+                          **server_options)
+    if preload is not None:
+        server.preload(preload, server.path_cache.max_entries or None)
+    Master(server, workers, reuse_port).run()
 
 
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser()
-    parser.add_argument('-w', help='Number of workers')
+    parser.add_argument('-w', type=int, default=os.cpu_count(),
+                        help='Number of workers [default: number of CPUs]')
     parser.add_argument('--bind', '-b', default='127.0.0.1', metavar='ADDRESS',
                         help='Specify alternate bind address '
                              '[default: all interfaces]')
     parser.add_argument('-r', default=os.getcwd(),
                         help='Specify alternative directory '
                              '[default:current directory]')
+    parser.add_argument('--preload', action='store_true',
+                        help='Before starting the workers, resolve every file under the document root '
+                             'and read the small ones into the caches the workers inherit')
+    parser.add_argument('--preload-manifest', metavar='FILE',
+                        help='Preload only the request paths listed in FILE, one per line')
+    parser.add_argument('--engine', '-e', choices=sorted(ENGINES), default='thread',
+                        help='Connection handling engine: thread per connection '
+                             'or asyncio event loop [default: thread]')
+    parser.add_argument('--reuse-port', action='store_true',
+                        help='Bind a SO_REUSEPORT socket in every worker instead '
+                             'of sharing the master socket')
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE, metavar='BYTES',
+                        help='Per-worker in-memory file cache budget, 0 disables it '
+                             f'[default: {DEFAULT_CACHE_SIZE}]')
+    parser.add_argument('--cache-max-file', type=int, default=DEFAULT_MAX_FILE_SIZE, metavar='BYTES',
+                        help='Largest file kept in the file cache '
+                             f'[default: {DEFAULT_MAX_FILE_SIZE}]')
+    parser.add_argument('--path-cache-entries', type=int, default=DEFAULT_PATH_CACHE_ENTRIES, metavar='N',
+                        help='Resolved request paths kept per worker, 0 disables the cache '
+                             f'[default: {DEFAULT_PATH_CACHE_ENTRIES}]')
+    parser.add_argument('--mime-types', action='append', default=[], metavar='FILE',
+                        help='Extra mime.types file, may be repeated')
+    parser.add_argument('--mime-type', action='append', default=[], type=parse_override, metavar='.EXT=TYPE',
+                        help='Content-Type override for one extension, may be repeated')
+    parser.add_argument('--charset', metavar='CHARSET',
+                        help='charset parameter added to text Content-Types [default: none]')
+    parser.add_argument('--request-timeout', type=float, default=10, metavar='SECONDS',
+                        help='Time allowed to receive a whole request from its first byte, 408 after that '
+                             '[default: 10]')
+    parser.add_argument('--write-timeout', type=float, default=WRITE_TIMEOUT, metavar='SECONDS',
+                        help=f'Base time allowed to send a response [default: {WRITE_TIMEOUT}]')
+    parser.add_argument('--min-rate', type=int, default=MIN_TRANSFER_RATE, metavar='BYTES',
+                        help='Bytes per second a client must at least read on top of the write timeout '
+                             f'[default: {MIN_TRANSFER_RATE}]')
+    parser.add_argument('--max-per-ip', type=int, default=MAX_CONNECTIONS_PER_IP, metavar='N',
+                        help='Concurrent connections per client address and worker, 0 for no limit '
+                             f'[default: {MAX_CONNECTIONS_PER_IP}]')
+    parser.add_argument('--shutdown-timeout', type=float, default=SHUTDOWN_TIMEOUT, metavar='SECONDS',
+                        help='Time old workers get on SIGHUP or SIGTERM to finish in-flight requests, '
+                             f'transfers still running after that are cut off [default: {SHUTDOWN_TIMEOUT}]')
+    parser.add_argument('--keepalive-timeout', type=float, default=KEEPALIVE_TIMEOUT, metavar='SECONDS',
+                        help='How long an idle keep-alive connection is kept open '
+                             f'[default: {KEEPALIVE_TIMEOUT}]')
+    parser.add_argument('--keepalive-requests', type=int, default=MAX_KEEPALIVE_REQUESTS, metavar='N',
+                        help='Requests served on one connection before it is closed '
+                             f'[default: {MAX_KEEPALIVE_REQUESTS}]')
+    parser.add_argument('--max-idle', type=int, default=MAX_IDLE_CONNECTIONS, metavar='N',
+                        help='Idle keep-alive connections allowed per worker, further '
+                             f'connections are closed after their response [default: {MAX_IDLE_CONNECTIONS}]')
+    parser.add_argument('--cache-control', action='append', default=[], type=parse_cache_control,
+                        metavar='PREFIX=SECONDS',
+                        help='Send Cache-Control: max-age=SECONDS for paths starting with PREFIX, '
+                             'may be repeated')
+    parser.add_argument('--autoindex', action='store_true',
+                        help='List directories without an index file, as JSON with ?format=json')
+    parser.add_argument('--mmap-cache-size', type=int, default=DEFAULT_MMAP_CACHE_SIZE, metavar='BYTES',
+                        help='Per-worker cap on bytes of memory-mapped files too big for the file cache, '
+                             'files must then be replaced by rename rather than rewritten in place '
+                             f'[default: {DEFAULT_MMAP_CACHE_SIZE}, off]')
+    parser.add_argument('--mmap-max-file', type=int, default=DEFAULT_MMAP_MAX_FILE_SIZE, metavar='BYTES',
+                        help=f'Largest file memory-mapped [default: {DEFAULT_MMAP_MAX_FILE_SIZE}]')
+    parser.add_argument('--no-compress', dest='compression', action='store_false',
+                        help='Never send gzip/br encoded responses, not even precompressed .gz/.br files')
+    parser.add_argument('--compress-cache-size', type=int, default=DEFAULT_COMPRESS_CACHE_SIZE, metavar='BYTES',
+                        help='Per-worker budget for compressed responses, 0 compresses on every request '
+                             f'[default: {DEFAULT_COMPRESS_CACHE_SIZE}]')
+    parser.add_argument('--compress-max-file', type=int, default=DEFAULT_COMPRESS_MAX_FILE_SIZE, metavar='BYTES',
+                        help='Largest file compressed on the fly '
+                             f'[default: {DEFAULT_COMPRESS_MAX_FILE_SIZE}]')
+    parser.add_argument('--threads', type=int, default=MAX_THREADS, metavar='N',
+                        help=f'Connection threads per worker of the thread engine [default: {MAX_THREADS}]')
+    parser.add_argument('--queue', type=int, default=MAX_QUEUED_CONNECTIONS, metavar='N',
+                        help='Accepted connections waiting for a thread before new ones get 503 '
+                             f'[default: {MAX_QUEUED_CONNECTIONS}]')
+    parser.add_argument('--retry-after', type=int, default=RETRY_AFTER, metavar='SECONDS',
+                        help=f'Retry-After sent with 503 responses [default: {RETRY_AFTER}]')
+    parser.add_argument('--backlog', type=int, default=LISTEN_BACKLOG, metavar='N',
+                        help='listen() backlog, capped by net.core.somaxconn '
+                             f'[default: {LISTEN_BACKLOG}]')
+    parser.add_argument('--access-log', default='-', metavar='FILE',
+                        help='Access log file, - for stderr, reopened on SIGUSR1 [default: -]')
+    parser.add_argument('--access-log-format', choices=ACCESS_LOG_FORMATS, default=ACCESS_LOG_FORMATS[0],
+                        help=f'Access log record format [default: {ACCESS_LOG_FORMATS[0]}]')
+    parser.add_argument('--access-log-sample', type=float, default=1.0, metavar='RATE',
+                        help='Fraction of successful requests logged, errors are always logged [default: 1]')
+    parser.add_argument('--no-access-log', dest='access_log', action='store_const', const=None,
+                        help='Disable the access log, e.g. for benchmarks')
+    parser.add_argument('--metrics-path', metavar='PATH',
+                        help='Serve Prometheus metrics of all workers at PATH, e.g. /__metrics [default: off]')
+    parser.add_argument('--rate-limit', action='append', default=[], type=parse_rate_limit,
+                        metavar='[PREFIX=]RATE[:BURST]',
+                        help='Allow each client address RATE requests per second, bursts of BURST [default: RATE], '
+                             'under PREFIX [default: /]; further requests get 429. May be repeated, every '
+                             'matching limit applies')
+    parser.add_argument('--rate-limit-table', type=int, default=DEFAULT_RATE_LIMIT_TABLE, metavar='N',
+                        help='Client buckets tracked across all workers, the least recently used are reset '
+                             f'when it is full [default: {DEFAULT_RATE_LIMIT_TABLE}]')
+    parser.add_argument('--proxy', action='append', default=[], type=parse_route, metavar='PREFIX=URL',
+                        help='Forward requests under PREFIX to an http:// upstream, e.g. '
+                             '/api/=http://127.0.0.1:9000/, may be repeated')
+    parser.add_argument('--proxy-connect-timeout', type=float, default=DEFAULT_CONNECT_TIMEOUT, metavar='SECONDS',
+                        help='Time allowed to connect to an upstream, or to wait for a free connection to it '
+                             f'[default: {DEFAULT_CONNECT_TIMEOUT:g}]')
+    parser.add_argument('--proxy-timeout', type=float, default=DEFAULT_UPSTREAM_TIMEOUT, metavar='SECONDS',
+                        help='Time allowed for each send to and read from an upstream '
+                             f'[default: {DEFAULT_UPSTREAM_TIMEOUT:g}]')
+    parser.add_argument('--proxy-max-connections', type=int, default=DEFAULT_MAX_UPSTREAM_CONNECTIONS,
+                        metavar='N', help='Connections per upstream and worker, idle ones are kept for reuse '
+                                          f'[default: {DEFAULT_MAX_UPSTREAM_CONNECTIONS}]')
+    parser.add_argument('--max-body-size', type=int, default=MAX_BODY_SIZE, metavar='BYTES',
+                        help='Largest request body accepted, such as one forwarded to an upstream; larger ones get 413 '
+                             f'[default: {MAX_BODY_SIZE}]')
     parser.add_argument('port', action='store',
                         default=80, type=int,
                         nargs='?',
                         help='Specify alternate port [default: 8000]')
     args = parser.parse_args()
+    access_log = None
+    if args.access_log is not None:
+        access_log = AccessLog(args.access_log, args.access_log_format, args.access_log_sample)
+    document_root = os.path.abspath(args.r)
+    preload = None
+    if args.preload_manifest:
+        try:
+            preload = list(read_manifest(args.preload_manifest))
+        except OSError as err:
+            parser.error(f'cannot read preload manifest: {err}')
+    elif args.preload:
+        preload = walk(document_root)
+    upstreams = {}
+    proxy_routes = []
+    for prefix, host, port, path in args.proxy:
+        if (host, port) not in upstreams:
+            upstreams[host, port] = Upstream(host, port, args.proxy_max_connections, args.proxy_connect_timeout,
+                                             args.proxy_timeout)
+        proxy_routes.append(Route(prefix, upstreams[host, port], path))
     server_address = args.bind, args.port
-    start_server(server_address, int(args.w))
+    start_server(server_address, args.w, args.engine, args.reuse_port, preload,
+                 document_root=document_root,
+                 cache_size=args.cache_size, cache_max_file_size=args.cache_max_file,
+                 path_cache_entries=args.path_cache_entries,
+                 mime_types=MimeTypes(args.mime_types, dict(args.mime_type), args.charset),
+                 keepalive_timeout=args.keepalive_timeout, max_keepalive_requests=args.keepalive_requests,
+                 max_idle_connections=args.max_idle, cache_control=args.cache_control,
+                 compression=args.compression, compress_cache_size=args.compress_cache_size,
+                 compress_max_file_size=args.compress_max_file, max_threads=args.threads,
+                 max_queued_connections=args.queue, retry_after=args.retry_after, backlog=args.backlog,
+                 access_log=access_log, metrics_path=args.metrics_path, timeout=args.request_timeout,
+                 write_timeout=args.write_timeout, min_transfer_rate=args.min_rate,
+                 shutdown_timeout=args.shutdown_timeout,
+                 max_connections_per_ip=args.max_per_ip, autoindex=args.autoindex,
+                 mmap_cache_size=args.mmap_cache_size, mmap_max_file_size=args.mmap_max_file,
+                 proxy_routes=proxy_routes, max_body_size=args.max_body_size,
+                 rate_limiter=RateLimiter(args.rate_limit, args.rate_limit_table) if args.rate_limit else None,
+                 # Room for a second set of workers during a reload
+                 metrics=Metrics(2 * args.w) if args.metrics_path else None)
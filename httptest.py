@@ -1,10 +1,33 @@
 #!/usr/bin/env python
 
+import copy
+import gzip
 import http.client
+import http.server
+import io
+import json
+import mimetypes
+import os
 import re
+import select
+import shutil
 import socket
+import tempfile
+import threading
+import time
 import unittest
 
+from src.access_log import AccessLog, JSON as ACCESS_LOG_JSON
+from src.async_server import AsyncServer, AsyncHTTPHandler
+from src.autoindex import RENDER_CHUNK
+from src.metrics import Metrics
+from src.mime import MimeTypes
+from src.parser import RequestParser
+from src.preload import walk
+from src.proxy import ProxyError, ResponseParser, Route, Upstream, parse_route
+from src.ratelimit import RateLimiter, Rule, parse_rule
+from src.server import Server, CustomHTTPHandler
+
 
 class HttpServer(unittest.TestCase):
     host = "localhost"
@@ -56,6 +79,13 @@ class HttpServer(unittest.TestCase):
         data = r.read()
         self.assertEqual(int(r.status), 404)
 
+    def test_file_with_null_byte(self):
+        """path with an encoded NUL byte returns 404"""
+        self.conn.request("GET", "/httptest/a%00b.html")
+        r = self.conn.getresponse()
+        r.read()
+        self.assertEqual(int(r.status), 404)
+
     def test_file_in_nested_folders(self):
         """file located in nested folders"""
         self.conn.request("GET", "/httptest/dir1/dir12/dir123/deep.txt")
@@ -125,6 +155,19 @@ class HttpServer(unittest.TestCase):
         data = r.read()
         self.assertIn(int(r.status), (400, 403, 404))
 
+    def test_document_root_escaping_relative(self):
+        """document root escaping forbidden for a target without a leading slash"""
+        s = socket.create_connection((self.host, self.port), timeout=10)
+        s.sendall(b"GET httptest/../../../../../../../../../../../../../etc/passwd HTTP/1.0\r\n\r\n")
+        data = b""
+        while 1:
+            buf = s.recv(65536)
+            if not buf: break
+            data += buf
+        s.close()
+        self.assertNotIn(b"root:", data)
+        self.assertRegex(data, rb"^HTTP/1\.1 (400|403|404) ")
+
     def test_file_with_dot_in_name(self):
         """file with two dots in name"""
         self.conn.request("GET", "/httptest/text..txt")
@@ -171,6 +214,20 @@ class HttpServer(unittest.TestCase):
         else:
             self.assertIn(int(code), (400, 405))
 
+    def test_pipelined_bare_lf(self):
+        """pipelined requests with LF and CRLF heads are answered in order"""
+        s = socket.create_connection((self.host, self.port), timeout=10)
+        s.sendall(b"GET /httptest/dir2/page.html HTTP/1.1\nHost: x\n\n"
+                  b"GET /httptest/text..txt HTTP/1.1\r\nConnection: close\r\n\r\n")
+        data = b""
+        while 1:
+            buf = s.recv(65536)
+            if not buf: break
+            data += buf
+        s.close()
+        self.assertEqual(data.count(b"HTTP/1.1 200 "), 2)
+        self.assertLess(data.index(b"Page Sample"), data.index(b"hello"))
+
     def test_filetype_html(self):
         """Content-Type for .html"""
         self.conn.request("GET", "/httptest/dir2/page.html")
@@ -267,11 +324,961 @@ class HttpServer(unittest.TestCase):
         self.assertEqual(len(data), 35344)
         self.assertEqual(ctype, "application/x-shockwave-flash")
 
+    def test_conditional_get_etag(self):
+        """If-None-Match with current ETag returns 304"""
+        self.conn.request("GET", "/httptest/splash.css")
+        r = self.conn.getresponse()
+        r.read()
+        etag = r.getheader("ETag")
+        self.assertIsNotNone(etag)
+        self.conn.request("GET", "/httptest/splash.css", headers={"If-None-Match": etag})
+        r = self.conn.getresponse()
+        data = r.read()
+        self.assertEqual(int(r.status), 304)
+        self.assertEqual(len(data), 0)
+
+    def test_conditional_get_last_modified(self):
+        """If-Modified-Since with Last-Modified returns 304"""
+        self.conn.request("GET", "/httptest/splash.css")
+        r = self.conn.getresponse()
+        r.read()
+        last_modified = r.getheader("Last-Modified")
+        self.assertIsNotNone(last_modified)
+        self.conn.request("GET", "/httptest/splash.css", headers={"If-Modified-Since": last_modified})
+        r = self.conn.getresponse()
+        r.read()
+        self.assertEqual(int(r.status), 304)
+
+    def test_range_request(self):
+        """byte range returns 206 with the requested slice"""
+        self.conn.request("GET", "/httptest/dir1/dir12/dir123/deep.txt", headers={"Range": "bytes=7-9"})
+        r = self.conn.getresponse()
+        data = r.read()
+        self.assertEqual(int(r.status), 206)
+        self.assertEqual(r.getheader("Content-Range"), "bytes 7-9/20")
+        self.assertEqual(data, b"you")
+
+    def test_range_not_satisfiable(self):
+        """range past the end returns 416"""
+        self.conn.request("GET", "/httptest/dir1/dir12/dir123/deep.txt", headers={"Range": "bytes=100-"})
+        r = self.conn.getresponse()
+        r.read()
+        self.assertEqual(int(r.status), 416)
+
+    def test_gzip_encoding(self):
+        """Accept-Encoding: gzip compresses text files"""
+        self.conn.request("GET", "/httptest/splash.css")
+        r = self.conn.getresponse()
+        identity = r.read()
+        self.conn.request("GET", "/httptest/splash.css", headers={"Accept-Encoding": "gzip"})
+        r = self.conn.getresponse()
+        data = r.read()
+        self.assertEqual(int(r.status), 200)
+        self.assertEqual(r.getheader("Content-Encoding"), "gzip")
+        self.assertEqual(r.getheader("Vary"), "Accept-Encoding")
+        self.assertEqual(gzip.decompress(data), identity)
+
+
+class InProcessServer(unittest.TestCase):
+    """Base for tests against a server run in this process over a temporary document root.
+
+    files maps paths under the root to their content, names ending in a
+    slash are directories; server_options() are passed to server_class.
+    """
+    server_class = Server
+    handler_class = CustomHTTPHandler
+    files = {}
+
+    @classmethod
+    def server_options(cls):
+        return {}
+
+    @classmethod
+    def setUpClass(cls):
+        cls.root = tempfile.mkdtemp()
+        for name, content in cls.files.items():
+            path = os.path.join(cls.root, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if not name.endswith("/"):
+                with open(path, "w") as f:
+                    f.write(content)
+        cls.server = cls.server_class(("127.0.0.1", 0), cls.handler_class, document_root=cls.root,
+                                      **cls.server_options())
+        cls.prepare()
+        cls.thread = threading.Thread(target=cls.server.serve_forever, kwargs={"poll_interval": 0.1})
+        cls.thread.start()
+
+    @classmethod
+    def prepare(cls):
+        """Called once the server is created, before it serves."""
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.thread.join()
+        shutil.rmtree(cls.root)
+
+    def setUp(self):
+        self.conn = http.client.HTTPConnection(*self.server.server_address, timeout=10)
+
+    def tearDown(self):
+        self.conn.close()
+
+
+class AutoindexServer(InProcessServer):
+    """In-process server with --autoindex on over a temporary document root."""
+    files = {"a.txt": "a", "sub/": None}
+
+    @classmethod
+    def server_options(cls):
+        return {"autoindex": True}
+
+    def test_root_listing(self):
+        """/ lists the document root, not the filesystem root"""
+        self.conn.request("GET", "/?format=json")
+        r = self.conn.getresponse()
+        data = json.loads(r.read())
+        self.assertEqual(int(r.status), 200)
+        self.assertEqual(data["path"], "/")
+        self.assertEqual([entry["name"] for entry in data["entries"]], ["sub", "a.txt"])
+        self.conn.request("GET", "/")
+        r = self.conn.getresponse()
+        data = r.read()
+        self.assertEqual(int(r.status), 200)
+        self.assertIn(b'href="/a.txt"', data)
+        self.assertNotIn(b'href="/etc/"', data)
+
+    def test_subdirectory_listing(self):
+        """directory without index file is listed"""
+        self.conn.request("GET", "/sub/", headers={"Accept": "application/json"})
+        r = self.conn.getresponse()
+        data = json.loads(r.read())
+        self.assertEqual(int(r.status), 200)
+        self.assertEqual(data, {"path": "/sub/", "entries": []})
+
+    def test_large_listing(self):
+        """listing of more than RENDER_CHUNK entries is streamed, then served from cache"""
+        big = os.path.join(self.root, "big")
+        os.mkdir(big)
+        self.addCleanup(shutil.rmtree, big)
+        names = [f"f{i:05}" for i in range(RENDER_CHUNK + 1)]
+        for name in names:
+            open(os.path.join(big, name), "w").close()
+        self.conn.request("GET", "/big/?format=json")
+        r = self.conn.getresponse()
+        data = json.loads(r.read())
+        self.assertEqual(int(r.status), 200)
+        self.assertEqual(r.getheader("Transfer-Encoding"), "chunked")
+        self.assertEqual([entry["name"] for entry in data["entries"]], names)
+        self.conn.request("GET", "/big/?format=json")
+        r = self.conn.getresponse()
+        self.assertEqual(json.loads(r.read()), data)
+        self.assertEqual(r.getheader("Transfer-Encoding"), None)
+        self.assertIsNotNone(r.getheader("Content-Length"))
+
+
+class AsyncAutoindexServer(AutoindexServer):
+    """In-process asyncio engine server with --autoindex on, listings scanned off the event loop"""
+    server_class = AsyncServer
+    handler_class = AsyncHTTPHandler
+
+
+class MmapServer(InProcessServer):
+    """In-process thread engine server mapping files too big for its file cache
+
+    The path cache is off, so that a file replaced on disk is looked up again
+    by the next request.
+    """
+    size = 64 * 1024
+    files = {"mid.bin": "".join(chr(ord("a") + i % 26) for i in range(size)), "swap.bin": "a" * size}
+
+    @classmethod
+    def server_options(cls):
+        return {"cache_size": 1024, "mmap_cache_size": 1024 * 1024, "path_cache_entries": 0}
+
+    def test_full_body(self):
+        """file over the file cache limit is served whole from its map"""
+        for _ in range(2):
+            self.conn.request("GET", "/mid.bin")
+            r = self.conn.getresponse()
+            self.assertEqual(int(r.status), 200)
+            self.assertEqual(r.read().decode(), self.files["mid.bin"])
+        self.assertGreaterEqual(self.server.mmap_cache.stats()["hits"], 1)
+
+    def test_range(self):
+        """byte range of a mapped file is a slice of the map"""
+        self.conn.request("GET", "/mid.bin")
+        self.conn.getresponse().read()
+        self.conn.request("GET", "/mid.bin", headers={"Range": "bytes=30000-30009"})
+        r = self.conn.getresponse()
+        self.assertEqual(int(r.status), 206)
+        self.assertEqual(r.getheader("Content-Range"), f"bytes 30000-30009/{self.size}")
+        self.assertEqual(r.read().decode(), self.files["mid.bin"][30000:30010])
+
+    def test_replaced(self):
+        """file replaced by renaming a new one over it is served fresh, not from the old map"""
+        path = os.path.join(self.root, "swap.bin")
+        self.conn.request("GET", "/swap.bin")
+        self.assertEqual(self.conn.getresponse().read(), b"a" * self.size)
+        with open(path + ".new", "w") as f:
+            f.write("b" * self.size)
+        mtime = os.stat(path).st_mtime_ns + 10 ** 9
+        os.utime(path + ".new", ns=(mtime, mtime))
+        os.replace(path + ".new", path)
+        self.conn.request("GET", "/swap.bin")
+        self.assertEqual(self.conn.getresponse().read(), b"b" * self.size)
+
+
+class AsyncMmapServer(MmapServer):
+    """In-process asyncio engine server mapping files too big for its file cache"""
+    server_class = AsyncServer
+    handler_class = AsyncHTTPHandler
+
+
+class DocumentRootServer(InProcessServer):
+    """In-process server over a temporary document root, preloaded before serving."""
+    files = {"index.html": "<html>root index</html>", "sub/page.txt": "page"}
+
+    @classmethod
+    def prepare(cls):
+        cls.preloaded = cls.server.preload(walk(cls.root))
+
+    def test_root_index(self):
+        """/ serves index.html of the document root"""
+        self.conn.request("GET", "/")
+        r = self.conn.getresponse()
+        data = r.read()
+        self.assertEqual(int(r.status), 200)
+        self.assertEqual(data, b"<html>root index</html>")
+
+    def test_preload(self):
+        """preloading resolves every path of the tree and reads the files"""
+        self.assertEqual(self.preloaded["paths"], 3)
+        self.assertEqual(self.preloaded["files"], 2)
+        self.conn.request("GET", "/sub/page.txt")
+        r = self.conn.getresponse()
+        self.assertEqual(r.read(), b"page")
+        self.assertEqual(self.server.file_cache.stats()["hits"], 1)
+
+
+class PreloadedPathCache(unittest.TestCase):
+    """Expired preloaded path cache entries are renewed while the file is unchanged"""
+
+    def test_revalidate(self):
+        """expired preloaded entry is renewed by a stat, dropped once the file changes"""
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        path = os.path.join(root, "page.txt")
+        with open(path, "w") as f:
+            f.write("page")
+        server = Server(("127.0.0.1", 0), CustomHTTPHandler, document_root=root, connect_now=False)
+        server.path_cache.ttl = -1
+        resolved = CustomHTTPHandler.detached(server).resolve_path("/page.txt")
+        server.path_cache.put("/page.txt", resolved, preloaded=True)
+        server.path_cache.put("/other", resolved)
+        self.assertEqual(server.path_cache.get("/page.txt"), (True, resolved))
+        self.assertEqual(server.path_cache.get("/other"), (False, None))
+        with open(path, "a") as f:
+            f.write("changed")
+        self.assertEqual(server.path_cache.get("/page.txt"), (False, None))
+
+
+class RequestParsing(unittest.TestCase):
+    """RequestParser on pipelined input"""
+
+    def parse(self, data):
+        parser = RequestParser()
+        parser.feed(data)
+        requests = []
+        while (request := parser.next_request()) is not None:
+            requests.append(request)
+        self.assertEqual(parser.buffer, b"")
+        return requests
+
+    def test_mixed_terminators(self):
+        """the first blank line ends a head, whether LF or CRLF terminated"""
+        requests = self.parse(b"GET /a HTTP/1.1\nHost: x\n\nGET /b HTTP/1.1\r\n\r\n"
+                              b"GET /c HTTP/1.1\r\nHost: y\n\r\nGET /d HTTP/1.1\r\nHost: z\r\n\r\n")
+        self.assertEqual([request.path for request in requests], ["/a", "/b", "/c", "/d"])
+        self.assertEqual([request.headers for request in requests],
+                         [{"host": "x"}, {}, {"host": "y"}, {"host": "z"}])
+
+
+class ResponseParsing(unittest.TestCase):
+    """ResponseParser on upstream responses fed in pieces"""
+
+    def parse(self, head, head_only=False):
+        parser = ResponseParser(head_only)
+        parser.feed(head)
+        self.assertTrue(parser.parse_head())
+        return parser
+
+    def test_chunked(self):
+        """chunked body is decoded across feeds, chunk extensions are ignored"""
+        parser = self.parse(b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n5;ext=1\r\nhel")
+        self.assertTrue(parser.chunked)
+        self.assertIsNone(parser.length)
+        self.assertEqual(parser.read_body(), b"hel")
+        parser.feed(b"lo\r\n6\r\n world\r")
+        self.assertEqual(parser.read_body(), b"lo world")
+        self.assertFalse(parser.done)
+        parser.feed(b"\n0\r\n\r\n")
+        self.assertEqual(parser.read_body(), b"")
+        self.assertTrue(parser.done)
+        self.assertTrue(parser.reusable())
+
+    def test_trailer(self):
+        """trailer fields after the last chunk are consumed up to the blank line"""
+        parser = self.parse(b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n2\r\nok\r\n0\r\n"
+                            b"X-Checksum: 1\r\n")
+        self.assertEqual(parser.read_body(), b"ok")
+        self.assertFalse(parser.done)
+        parser.feed(b"X-Other: 2\r\n\r\n")
+        self.assertEqual(parser.read_body(), b"")
+        self.assertTrue(parser.done)
+        self.assertTrue(parser.reusable())
+
+    def test_bad_chunk_size(self):
+        """non-hex chunk size is a 502"""
+        parser = self.parse(b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\nzz\r\n")
+        with self.assertRaises(ProxyError) as cm:
+            parser.read_body()
+        self.assertEqual(cm.exception.code, 502)
+
+    def test_content_length(self):
+        """body ends after Content-Length bytes, the rest stays buffered"""
+        parser = self.parse(b"HTTP/1.1 200 OK\r\nContent-Length: 4\r\n\r\nbodyextra")
+        self.assertEqual(parser.length, 4)
+        self.assertEqual(parser.read_body(), b"body")
+        self.assertTrue(parser.done)
+        self.assertFalse(parser.reusable())
+
+    def test_eof_delimited(self):
+        """body without length runs to EOF and the connection is not reused"""
+        parser = self.parse(b"HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\n\r\nsome")
+        self.assertFalse(parser.keep_alive)
+        self.assertEqual(parser.read_body(), b"some")
+        parser.feed(b" more")
+        self.assertEqual(parser.read_body(), b" more")
+        self.assertFalse(parser.done)
+        parser.feed_eof()
+        self.assertTrue(parser.done)
+        self.assertFalse(parser.reusable())
+
+    def test_eof_truncated(self):
+        """EOF before the end of a delimited body is a 502"""
+        for head in (b"HTTP/1.1 200 OK\r\nContent-Length: 10\r\n\r\nshort",
+                     b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\na\r\nshort"):
+            parser = self.parse(head)
+            parser.read_body()
+            with self.assertRaises(ProxyError) as cm:
+                parser.feed_eof()
+            self.assertEqual(cm.exception.code, 502)
+
+    def test_interim_responses(self):
+        """1xx responses are skipped, also when the final head arrives later"""
+        parser = ResponseParser()
+        parser.feed(b"HTTP/1.1 100 Continue\r\n\r\nHTTP/1.1 103 Early Hints\r\nLink: </a.css>\r\n\r\nHTTP/1.1 2")
+        self.assertFalse(parser.parse_head())
+        parser.feed(b"00 OK\r\nContent-Length: 2\r\n\r\nok")
+        self.assertTrue(parser.parse_head())
+        self.assertEqual((parser.status, parser.reason), (200, "OK"))
+        self.assertEqual(parser.headers, [("Content-Length", "2")])
+        self.assertEqual(parser.read_body(), b"ok")
+
+    def test_switching_protocols(self):
+        """101 is refused"""
+        parser = ResponseParser()
+        parser.feed(b"HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\n\r\n")
+        with self.assertRaises(ProxyError):
+            parser.parse_head()
+
+    def test_no_body(self):
+        """responses to HEAD, 204 and 304 have no body whatever their headers say"""
+        self.assertTrue(self.parse(b"HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\n", head_only=True).done)
+        self.assertTrue(self.parse(b"HTTP/1.1 204 No Content\r\n\r\n").done)
+        parser = self.parse(b"HTTP/1.1 304 Not Modified\r\nContent-Length: 5\r\n\r\n")
+        self.assertTrue(parser.reusable())
+        self.assertEqual(parser.declared_length(), "5")
+
+    def test_connection_close(self):
+        """Connection: close and HTTP/1.0 responses are not reused"""
+        self.assertFalse(self.parse(b"HTTP/1.1 200 OK\r\nConnection: close\r\nContent-Length: 0\r\n\r\n")
+                         .reusable())
+        self.assertFalse(self.parse(b"HTTP/1.0 200 OK\r\nContent-Length: 0\r\n\r\n").reusable())
+
+
+class ProxyRoutes(unittest.TestCase):
+    """--proxy rules and the request paths they forward"""
+
+    def test_parse_route(self):
+        """prefix, host, port and path of a rule"""
+        self.assertEqual(parse_route("/api/=http://127.0.0.1:9000/v1/"), ("/api/", "127.0.0.1", 9000, "/v1/"))
+        self.assertEqual(parse_route("/api/=http://backend"), ("/api/", "backend", 80, None))
+
+    def test_parse_route_invalid(self):
+        """rules without a /prefix or an http:// upstream are rejected"""
+        for value in ("http://backend", "api=http://backend", "/api/=https://backend", "/api/=http://"):
+            with self.assertRaises(ValueError):
+                parse_route(value)
+
+    def test_target(self):
+        """the prefix is replaced by the upstream path, if there is one"""
+        upstream = Upstream("127.0.0.1", 9000)
+        self.assertEqual(Route("/api/", upstream, "/v1/").target("/api/users?id=1"), "/v1/users?id=1")
+        self.assertEqual(Route("/api/", upstream).target("/api/users?id=1"), "/api/users?id=1")
+        self.assertEqual(Route("/api/", upstream, "/v1/").target("/api/a/../b%20c/%2e/d"), "/v1/b%20c/d")
+
+
+class ProxyServer(InProcessServer):
+    """In-process server forwarding /api/ to an in-process upstream"""
+
+    @classmethod
+    def setUpClass(cls):
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                for piece in (self.path.encode(), b" ", self.headers["X-Forwarded-For"].encode()):
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(piece), piece))
+                self.wfile.write(b"0\r\n\r\n")
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        cls.upstream = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        cls.upstream_thread = threading.Thread(target=cls.upstream.serve_forever, kwargs={"poll_interval": 0.1})
+        cls.upstream_thread.start()
+        super().setUpClass()
+
+    @classmethod
+    def server_options(cls):
+        return {"proxy_routes": [Route("/api/", Upstream(*cls.upstream.server_address), "/v1/")],
+                "max_body_size": 16}
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.upstream.shutdown()
+        cls.upstream_thread.join()
+        cls.upstream.server_close()
+
+    def test_forward(self):
+        """requests under the prefix are forwarded with the path rewritten, on a reused connection"""
+        conn = self.conn
+        for _ in range(2):
+            conn.request("GET", "/api/users?id=1")
+            r = conn.getresponse()
+            self.assertEqual(int(r.status), 200)
+            self.assertEqual(r.read(), b"/v1/users?id=1 127.0.0.1")
+        self.assertEqual(self.server.upstreams()[0].reused, 1)
+        conn.request("GET", "/other")
+        r = conn.getresponse()
+        r.read()
+        self.assertEqual(int(r.status), 404)
+
+    def test_normalized(self):
+        """routes match the normalized path and dot segments cannot leave the upstream prefix"""
+        conn = self.conn
+        for path, forwarded in (("//api/x", b"/v1/x"), ("/./api/a/../b", b"/v1/b"), ("/api/%2e%2e/api/c", b"/v1/c")):
+            conn.request("GET", path)
+            r = conn.getresponse()
+            self.assertEqual(int(r.status), 200, path)
+            self.assertEqual(r.read(), forwarded + b" 127.0.0.1")
+        for path in ("/api/../admin", "/api/%2e%2e/admin", "/api/%2E%2E/../admin"):
+            conn.request("GET", path)
+            r = conn.getresponse()
+            r.read()
+            self.assertEqual(int(r.status), 404, path)
+
+    def test_max_body_size(self):
+        """request body up to max_body_size is forwarded, a larger one gets 413"""
+        self.conn.request("POST", "/api/upload", body=b"x" * 16)
+        r = self.conn.getresponse()
+        self.assertEqual(int(r.status), 200)
+        self.assertEqual(r.read(), b"x" * 16)
+        self.conn.request("POST", "/api/upload", body=b"x" * 17)
+        r = self.conn.getresponse()
+        r.read()
+        self.assertEqual(int(r.status), 413)
+
+
+class AsyncProxyServer(ProxyServer):
+    """In-process asyncio engine server forwarding /api/ to an in-process upstream"""
+    server_class = AsyncServer
+    handler_class = AsyncHTTPHandler
+
+
+class RateLimiting(unittest.TestCase):
+    """Token buckets of RateLimiter and the --rate-limit rules"""
+
+    def test_parse_rule(self):
+        """prefix defaults to /, burst to the rate rounded up"""
+        rule = parse_rule("10")
+        self.assertEqual((rule.prefix, rule.rate, rule.burst), ("/", 10, 10))
+        rule = parse_rule("/api/=2.5:5")
+        self.assertEqual((rule.prefix, rule.rate, rule.burst), ("/api/", 2.5, 5))
+        self.assertEqual(parse_rule("0.5").burst, 1)
+
+    def test_parse_rule_invalid(self):
+        """non-positive rates, bursts below one and relative prefixes are rejected"""
+        for value in ("0", "-1", "api=1", "/api/=1:0.5", "fast"):
+            with self.assertRaises(ValueError):
+                parse_rule(value)
+
+    def test_burst_and_refill(self):
+        """a full bucket allows burst requests, then refills at rate"""
+        rule = Rule("/", 2, 3)
+        limiter = RateLimiter([rule], 64)
+        self.assertEqual([limiter._take(1, rule, 0) for _ in range(3)], [0, 0, 0])
+        self.assertEqual(limiter._take(1, rule, 0), 0.5)
+        self.assertEqual(limiter._take(1, rule, 0.25), 0.25)
+        self.assertEqual(limiter._take(1, rule, 0.5), 0)
+        self.assertEqual(limiter._take(1, rule, 0.5), 0.5)
+        # Refilled up to burst, not beyond
+        self.assertEqual([limiter._take(1, rule, 100) for _ in range(4)], [0, 0, 0, 0.5])
+        self.assertEqual(limiter._take(2, rule, 100), 0)
+
+    def test_full_group(self):
+        """the least recently used bucket of a full group is taken over"""
+        rule = Rule("/", 0.001, 1)
+        limiter = RateLimiter([rule], 8)
+        for key in range(1, 9):
+            limiter._take(key, rule, key)
+        self.assertGreater(limiter._take(2, rule, 9), 0)
+        self.assertEqual(limiter._take(9, rule, 10), 0)
+        self.assertEqual(limiter._take(1, rule, 11), 0)
+        self.assertGreater(limiter._take(1, rule, 12), 0)
+
+    def test_narrow_and_broad(self):
+        """every matching rule is charged, broader ones not for a request a narrower one refused"""
+        limiter = RateLimiter([Rule("/", 0.001, 3), Rule("/api/", 0.001, 1)], 64)
+        self.assertEqual(limiter.check("10.0.0.1", "/api/a"), 0)
+        self.assertGreater(limiter.check("10.0.0.1", "/%61pi/a?x=1"), 0)
+        for path in ("//api/a", "/./api/a", "/x/../api/a", "api/a"):
+            self.assertGreater(limiter.check("10.0.0.1", path), 0, path)
+        self.assertEqual(limiter.check("10.0.0.1", "/index.html"), 0)
+        self.assertEqual(limiter.check("10.0.0.1", "/index.html"), 0)
+        self.assertGreater(limiter.check("10.0.0.1", "/index.html"), 0)
+        self.assertEqual(limiter.check("10.0.0.2", "/api/a"), 0)
+
+
+class RateLimitServer(InProcessServer):
+    """In-process server with a rate limit"""
+
+    @classmethod
+    def server_options(cls):
+        return {"rate_limiter": RateLimiter([parse_rule("/=0.4:1")], 64)}
+
+    def test_retry_after(self):
+        """refused request gets 429 with the seconds until the next token"""
+        self.conn.request("GET", "/")
+        r = self.conn.getresponse()
+        r.read()
+        self.assertEqual(int(r.status), 404)
+        self.conn.request("GET", "/")
+        r = self.conn.getresponse()
+        r.read()
+        self.assertEqual(int(r.status), 429)
+        self.assertEqual(r.getheader("Retry-After"), "3")
+
+
+class AccessLogServer(InProcessServer):
+    """In-process server writing a JSON access log, with a short write deadline"""
+    size = 20 * 1024 * 1024
+    files = {"big.bin": "x" * size}
+
+    @classmethod
+    def server_options(cls):
+        cls.log_path = os.path.join(cls.root, "access.log")
+        cls.access_log = AccessLog(cls.log_path, ACCESS_LOG_JSON, flush_interval=0.1)
+        return {"access_log": cls.access_log, "cache_size": 0, "write_timeout": 0.5, "min_transfer_rate": 0}
+
+    def records(self, count):
+        """The first count records of the log, waiting up to 5 seconds for them"""
+        deadline = time.monotonic() + 5
+        while 1:
+            with open(self.log_path) as f:
+                lines = f.readlines()
+            if len(lines) >= count or time.monotonic() > deadline: break
+            time.sleep(0.05)
+        return [json.loads(line) for line in lines[:count]]
+
+    def test_aborted_transfer(self):
+        """transfer cut off by the write deadline is logged with the bytes sent until then"""
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.addCleanup(s.close)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        s.connect(self.server.server_address)
+        s.sendall(b"GET /big.bin HTTP/1.1\r\n\r\n")
+        self.conn.request("GET", "/missing")
+        r = self.conn.getresponse()
+        r.read()
+        records = sorted(self.records(2), key=lambda record: record["path"])
+        self.assertEqual([(record["path"], record["status"]) for record in records],
+                         [("/big.bin", 200), ("/missing", 404)])
+        self.assertGreater(records[0]["bytes"], 0)
+        self.assertLess(records[0]["bytes"], self.size)
+
+    def test_no_status(self):
+        """request that failed before a status line is logged as 499"""
+        access_log = AccessLog(os.path.join(self.root, "sampled.log"), ACCESS_LOG_JSON, sample=0.5)
+        server = Server(("127.0.0.1", 0), CustomHTTPHandler, document_root=self.root, connect_now=False,
+                        access_log=access_log)
+        handler = CustomHTTPHandler.detached(server)
+        handler.request_address = ("127.0.0.1", 1)
+        handler.method, handler.path, handler.request_version = "GET", "/big.bin", "HTTP/1.1"
+        handler.status_code = None
+        handler.bytes_sent = 0
+        handler._started = time.monotonic()
+        handler.log_request()
+        self.assertEqual(access_log._queue.get_nowait()[5], 499)
+
+
+class MetricsCounters(unittest.TestCase):
+    """Metrics slots shared by the workers"""
+
+    def test_detached(self):
+        """a worker without a slot of its own publishes nothing"""
+        metrics = Metrics(2)
+        Server(("127.0.0.1", 0), CustomHTTPHandler, connect_now=False, metrics=metrics)
+        self.assertEqual(metrics.slot, 0)
+        metrics.detach()
+        metrics.record("GET", 200, 100, 0.01)
+        metrics.publish(force=True)
+        self.assertNotIn(b"httpd_requests_total{", metrics.render())
+
+    def test_render_sums_slots(self):
+        """render() adds up the slots of all workers; counters outlive a worker, gauges do not"""
+        metrics = Metrics(2)
+        first, second = copy.copy(metrics), copy.copy(metrics)
+        first.attach(0)
+        second.attach(1)
+        first.record("GET", 200, 100, 0.001)
+        first.record("GET", 200, 100, 0.001)
+        second.record("HEAD", 404, 50, 0.2)
+        second.record("POST", 200, 10, 3)
+        first.publish(lambda: {"threads": 2, "file_cache_hits": 5}, force=True)
+        second.publish(lambda: {"threads": 3, "file_cache_hits": 1}, force=True)
+        lines = metrics.render().decode().splitlines()
+        for line in ('httpd_requests_total{code="200"} 3', 'httpd_requests_total{code="404"} 1',
+                     'httpd_requests_by_method_total{method="GET"} 2',
+                     'httpd_requests_by_method_total{method="HEAD"} 1',
+                     'httpd_requests_by_method_total{method="other"} 1',
+                     'httpd_request_duration_seconds_bucket{le="0.001"} 2',
+                     'httpd_request_duration_seconds_bucket{le="2.5"} 3',
+                     'httpd_request_duration_seconds_bucket{le="+Inf"} 4',
+                     'httpd_request_duration_seconds_count 4', 'httpd_response_bytes_total 260',
+                     'httpd_threads 5', 'httpd_file_cache_hits_total 6'):
+            self.assertIn(line, lines)
+        metrics.release(1)
+        respawned = copy.copy(metrics)
+        respawned.attach(1)
+        respawned.publish(lambda: {"threads": 1, "file_cache_hits": 0}, force=True)
+        lines = metrics.render().decode().splitlines()
+        self.assertIn("httpd_threads 3", lines)
+        self.assertIn("httpd_file_cache_hits_total 6", lines)
+        self.assertIn('httpd_requests_total{code="200"} 3', lines)
+
+
+class MetricsServer(InProcessServer):
+    """In-process thread engine server serving its metrics"""
+    files = {"a.txt": "aaa"}
+
+    @classmethod
+    def server_options(cls):
+        return {"metrics": Metrics(1), "metrics_path": "/__metrics"}
+
+    def test_metrics_path(self):
+        """metrics_path serves the counters, up to date with the requests before it"""
+        for path in ("/a.txt", "/a.txt", "/missing"):
+            self.conn.request("GET", path)
+            self.conn.getresponse().read()
+        self.conn.request("GET", "/__metrics?x=1")
+        r = self.conn.getresponse()
+        lines = r.read().decode().splitlines()
+        self.assertEqual(int(r.status), 200)
+        self.assertTrue(r.getheader("Content-Type").startswith("text/plain; version=0.0.4"))
+        self.assertEqual(r.getheader("Cache-Control"), "no-store")
+        self.assertIn('httpd_requests_total{code="200"} 2', lines)
+        self.assertIn('httpd_requests_total{code="404"} 1', lines)
+        self.assertIn('httpd_requests_by_method_total{method="GET"} 3', lines)
+
+
+class AsyncMetricsServer(MetricsServer):
+    """In-process asyncio engine server serving its metrics"""
+    server_class = AsyncServer
+    handler_class = AsyncHTTPHandler
+
+
+class MimeTable(unittest.TestCase):
+    """Content-Type table of MimeTypes"""
+
+    @unittest.skipUnless(any(os.path.isfile(name) for name in mimetypes.knownfiles), "no system mime.types")
+    def test_system_types(self):
+        """types of the system mime.types tables are known, .swf keeps its type"""
+        types = MimeTypes()
+        for name, ctype in (("a.woff2", "font/woff2"), ("a.webp", "image/webp"), ("a.flac", "audio/flac"),
+                            ("a.swf", "application/x-shockwave-flash")):
+            self.assertEqual(types.guess_type(name), ctype)
+
+    def test_overrides(self):
+        """files and overrides are applied last, unknown extensions are octet-stream"""
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        path = os.path.join(root, "mime.types")
+        with open(path, "w") as f:
+            f.write("application/x-test test\n")
+        types = MimeTypes([path], {".swf": "application/vnd.adobe.flash.movie"}, "utf-8")
+        self.assertEqual(types.guess_type("a.test"), "application/x-test")
+        self.assertEqual(types.guess_type("a.swf"), "application/vnd.adobe.flash.movie")
+        self.assertEqual(types.guess_type("a.HTML"), "text/html; charset=utf-8")
+        self.assertEqual(types.guess_type("a.unknown-extension"), "application/octet-stream")
+
+
+class _Replay(io.BytesIO):
+    """Socket stand-in that lets http.client read several responses off one buffer"""
+
+    def makefile(self, mode):
+        return self
+
+    def close(self):
+        pass
+
+
+class KeepAliveServer(InProcessServer):
+    """In-process thread engine server, keep-alive and pipelining"""
+    files = {"a.txt": "aaa", "b.txt": "bb"}
+
+    @classmethod
+    def server_options(cls):
+        return {"keepalive_timeout": 0.5, "max_keepalive_requests": 3}
+
+    def connect(self):
+        s = socket.create_connection(self.server.server_address, timeout=10)
+        self.addCleanup(s.close)
+        return s
+
+    def exchange(self, s, data, methods):
+        """Send data and read one response per method until the server closes"""
+        s.sendall(data)
+        received = b""
+        while 1:
+            buf = s.recv(65536)
+            if not buf: break
+            received += buf
+        replay = _Replay(received)
+        responses = []
+        for method in methods:
+            r = http.client.HTTPResponse(replay, method=method)
+            r.begin()
+            responses.append((r, r.read()))
+        self.assertEqual(replay.read(), b"")
+        return responses
+
+    def test_persistent(self):
+        """HTTP/1.1 connection serves requests until the cap, announced in Keep-Alive"""
+        s = self.connect()
+        responses = self.exchange(s, b"GET /a.txt HTTP/1.1\r\n\r\n" * 4, ["GET"] * 3)
+        self.assertEqual([body for r, body in responses], [b"aaa"] * 3)
+        self.assertEqual([r.getheader("Connection") for r, body in responses], ["keep-alive", "keep-alive", "close"])
+        self.assertEqual(responses[0][0].getheader("Keep-Alive"), "timeout=0.5, max=2")
+        self.assertEqual(responses[1][0].getheader("Keep-Alive"), "timeout=0.5, max=1")
+
+    def test_http10(self):
+        """HTTP/1.0 connection is closed unless keep-alive is asked for"""
+        s = self.connect()
+        responses = self.exchange(s, b"GET /a.txt HTTP/1.0\r\nConnection: keep-alive\r\n\r\n"
+                                     b"GET /b.txt HTTP/1.0\r\n\r\nGET /a.txt HTTP/1.0\r\n\r\n", ["GET"] * 2)
+        self.assertEqual([r.getheader("Connection") for r, body in responses], ["keep-alive", "close"])
+        self.assertEqual(responses[1][1], b"bb")
+
+    def test_idle_timeout(self):
+        """idle connection is closed after the keep-alive timeout"""
+        s = self.connect()
+        s.sendall(b"GET /a.txt HTTP/1.1\r\n\r\n")
+        r = http.client.HTTPResponse(s)
+        r.begin()
+        self.assertEqual(r.read(), b"aaa")
+        s.settimeout(5)
+        self.assertEqual(s.recv(1024), b"")
+
+    def test_pipelined(self):
+        """pipelined requests sent at once are answered in order"""
+        s = self.connect()
+        responses = self.exchange(s, b"GET /a.txt HTTP/1.1\r\n\r\nHEAD /b.txt HTTP/1.1\r\n\r\n"
+                                     b"GET /missing HTTP/1.1\r\nConnection: close\r\n\r\n",
+                                  ["GET", "HEAD", "GET"])
+        self.assertEqual([r.status for r, body in responses], [200, 200, 404])
+        self.assertEqual(responses[0][1], b"aaa")
+        self.assertEqual(responses[1][0].getheader("Content-Length"), "2")
+        self.assertEqual(responses[1][1], b"")
+
+
+class AsyncKeepAliveServer(KeepAliveServer):
+    """In-process asyncio engine server, keep-alive and pipelining"""
+    server_class = AsyncServer
+    handler_class = AsyncHTTPHandler
+
+
+class SlowClientServer(InProcessServer):
+    """In-process thread engine server with short header-read and body-write deadlines"""
+    size = 20 * 1024 * 1024
+    files = {"a.txt": "aaa", "big.bin": "x" * size}
+
+    @classmethod
+    def server_options(cls):
+        return {"timeout": 0.5, "write_timeout": 0.25, "min_transfer_rate": 64 * 1024 * 1024, "cache_size": 0}
+
+    def connect(self):
+        s = socket.create_connection(self.server.server_address, timeout=10)
+        self.addCleanup(s.close)
+        return s
+
+    def read_all(self, s):
+        """Everything received until the server closes or resets the connection"""
+        received = b""
+        try:
+            while 1:
+                buf = s.recv(65536)
+                if not buf: break
+                received += buf
+        except ConnectionResetError:
+            pass
+        return received
+
+    def test_trickled_head(self):
+        """head trickled in a byte at a time is answered with 408 once the timeout has passed"""
+        s = self.connect()
+        started = time.monotonic()
+        for byte in b"GET /a.txt HTTP/1.1\r\nX-Slow: " + b"x" * 100:
+            s.send(bytes([byte]))
+            if select.select([s], [], [], 0.05)[0]: break
+        data = self.read_all(s)
+        self.assertTrue(data.startswith(b"HTTP/1.1 408 "))
+        self.assertLess(time.monotonic() - started, 2)
+
+    def test_write_deadline(self):
+        """transfer to a client that stops reading is cut off at write_timeout + size / min_transfer_rate"""
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.addCleanup(s.close)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        s.connect(self.server.server_address)
+        s.sendall(b"GET /big.bin HTTP/1.1\r\n\r\n")
+        time.sleep(1.5)
+        s.settimeout(10)
+        self.assertLess(len(self.read_all(s)), self.size)
+
+
+class AsyncSlowClientServer(SlowClientServer):
+    """In-process asyncio engine server with short header-read and body-write deadlines"""
+    server_class = AsyncServer
+    handler_class = AsyncHTTPHandler
+
+
+class ConnectionLimitServer(InProcessServer):
+    """In-process thread engine server allowing one connection per client address"""
+    files = {"a.txt": "aaa"}
+
+    @classmethod
+    def server_options(cls):
+        return {"max_connections_per_ip": 1, "retry_after": 3}
+
+    def test_second_connection(self):
+        """connection over the per-IP limit is answered with 503 right away, the first one is still served"""
+        self.conn.request("GET", "/a.txt")
+        self.assertEqual(self.conn.getresponse().read(), b"aaa")
+        s = socket.create_connection(self.server.server_address, timeout=10)
+        self.addCleanup(s.close)
+        r = http.client.HTTPResponse(s)
+        r.begin()
+        self.assertEqual(r.status, 503)
+        self.assertEqual(r.getheader("Retry-After"), "3")
+        self.assertEqual(r.getheader("Connection"), "close")
+        self.conn.request("GET", "/a.txt")
+        self.assertEqual(self.conn.getresponse().read(), b"aaa")
+
+
+class AsyncConnectionLimitServer(ConnectionLimitServer):
+    """In-process asyncio engine server allowing one connection per client address"""
+    server_class = AsyncServer
+    handler_class = AsyncHTTPHandler
+
+
+class SaturatedServer(InProcessServer):
+    """In-process thread engine server with one thread and room for one queued connection"""
+    files = {"a.txt": "aaa"}
+
+    @classmethod
+    def server_options(cls):
+        return {"max_threads": 1, "max_queued_connections": 1, "retry_after": 2}
+
+    def connect(self):
+        s = socket.create_connection(self.server.server_address, timeout=10)
+        self.addCleanup(s.close)
+        return s
+
+    def test_queue_full(self):
+        """connection beyond the queue gets 503 with Retry-After, connections served meanwhile are not kept alive"""
+        busy = self.connect()
+        busy.sendall(b"GET /a.txt HTTP/1.1\r\n")
+        time.sleep(0.2)
+        queued = self.connect()
+        queued.sendall(b"GET /a.txt HTTP/1.1\r\n\r\n")
+        time.sleep(0.2)
+        r = http.client.HTTPResponse(self.connect())
+        r.begin()
+        self.assertEqual(r.status, 503)
+        self.assertEqual(r.getheader("Retry-After"), "2")
+        self.assertEqual(r.read(), b"")
+        busy.sendall(b"\r\n")
+        for s in busy, queued:
+            r = http.client.HTTPResponse(s)
+            r.begin()
+            self.assertEqual(r.read(), b"aaa")
+            self.assertEqual(r.getheader("Connection"), "close")
+            self.assertEqual(s.recv(1024), b"")
+
 
 loader = unittest.TestLoader()
 suite = unittest.TestSuite()
 a = loader.loadTestsFromTestCase(HttpServer)
 suite.addTest(a)
+suite.addTest(loader.loadTestsFromTestCase(AutoindexServer))
+suite.addTest(loader.loadTestsFromTestCase(AsyncAutoindexServer))
+suite.addTest(loader.loadTestsFromTestCase(MmapServer))
+suite.addTest(loader.loadTestsFromTestCase(AsyncMmapServer))
+suite.addTest(loader.loadTestsFromTestCase(DocumentRootServer))
+suite.addTest(loader.loadTestsFromTestCase(PreloadedPathCache))
+suite.addTest(loader.loadTestsFromTestCase(RequestParsing))
+suite.addTest(loader.loadTestsFromTestCase(ResponseParsing))
+suite.addTest(loader.loadTestsFromTestCase(ProxyRoutes))
+suite.addTest(loader.loadTestsFromTestCase(ProxyServer))
+suite.addTest(loader.loadTestsFromTestCase(AsyncProxyServer))
+suite.addTest(loader.loadTestsFromTestCase(RateLimiting))
+suite.addTest(loader.loadTestsFromTestCase(RateLimitServer))
+suite.addTest(loader.loadTestsFromTestCase(AccessLogServer))
+suite.addTest(loader.loadTestsFromTestCase(MetricsCounters))
+suite.addTest(loader.loadTestsFromTestCase(MetricsServer))
+suite.addTest(loader.loadTestsFromTestCase(AsyncMetricsServer))
+suite.addTest(loader.loadTestsFromTestCase(MimeTable))
+suite.addTest(loader.loadTestsFromTestCase(KeepAliveServer))
+suite.addTest(loader.loadTestsFromTestCase(AsyncKeepAliveServer))
+suite.addTest(loader.loadTestsFromTestCase(SlowClientServer))
+suite.addTest(loader.loadTestsFromTestCase(AsyncSlowClientServer))
+suite.addTest(loader.loadTestsFromTestCase(ConnectionLimitServer))
+suite.addTest(loader.loadTestsFromTestCase(AsyncConnectionLimitServer))
+suite.addTest(loader.loadTestsFromTestCase(SaturatedServer))
 
 
 class NewResult(unittest.TextTestResult):
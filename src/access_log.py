@@ -0,0 +1,154 @@
+import json
+import logging
+import os
+import queue
+import random
+import sys
+import threading
+import time
+
+COMBINED = 'combined'
+JSON = 'json'
+FORMATS = (COMBINED, JSON)
+# Records written per batch, and the longest a record waits in the queue
+BATCH_SIZE = 256
+FLUSH_INTERVAL = 1.0
+MAX_QUEUED_RECORDS = 65536
+WRITE_BUFSIZE = 64 * 1024
+
+_STOP = object()
+
+
+class AccessLog:
+    """Access log written by a background thread.
+
+    log() only puts a tuple of the request's fields on a queue; the writer
+    thread formats them in batches and writes through a buffered file, so
+    neither formatting nor I/O happens on the request path. The thread is
+    started in each worker by start(), after the fork. reopen() makes the
+    writer reopen the file, which is what logrotate expects on SIGUSR1.
+
+    With sample below 1 only that fraction of successful requests is
+    logged; errors are always logged. When the queue is full records are
+    dropped and counted rather than blocking the request.
+    """
+
+    def __init__(self, path='-', fmt=COMBINED, sample=1.0, batch_size=BATCH_SIZE,
+                 flush_interval=FLUSH_INTERVAL, max_queued=MAX_QUEUED_RECORDS):
+        if fmt not in FORMATS:
+            raise ValueError(f'unknown access log format {fmt!r}')
+        self.path = path
+        self.format = fmt
+        self.sample = sample
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self._queue = queue.Queue(max_queued)
+        self._thread = None
+        self._file = None
+        self._reopen = False
+        self._time_cache = (0, '')
+
+    def start(self):
+        self._open()
+        self._thread = threading.Thread(target=self._run, name='access-log', daemon=True)
+        self._thread.start()
+
+    def close(self, timeout=5):
+        """Write out the queued records and stop the writer thread."""
+        if self._thread is None:
+            return
+        try:
+            self._queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            pass
+        self._thread.join(timeout)
+        self._thread = None
+
+    def reopen(self):
+        """Reopen the log file before the next batch; safe to call from a signal handler."""
+        self._reopen = True
+
+    def log(self, address, method, path, version, status, size, referer, user_agent, duration):
+        if self.sample < 1.0 and status < 400 and random.random() >= self.sample:
+            return
+        try:
+            self._queue.put_nowait((time.time(), address, method, path, version, status, size,
+                                    referer, user_agent, duration))
+        except queue.Full:
+            self.dropped += 1
+
+    def _open(self):
+        if self.path == '-':
+            self._file = sys.stderr
+        else:
+            self._file = open(self.path, 'a', buffering=WRITE_BUFSIZE, encoding='utf-8', errors='replace')
+
+    def _close_file(self):
+        if self._file is not None and self._file is not sys.stderr:
+            self._file.close()
+        self._file = None
+
+    def _run(self):
+        get = self._queue.get
+        while True:
+            try:
+                record = get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+            batch = []
+            while record is not _STOP:
+                batch.append(record)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    record = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            self._write(batch)
+            if record is _STOP:
+                self._close_file()
+                return
+
+    def _write(self, batch):
+        if self._reopen:
+            self._reopen = False
+            self._close_file()
+            try:
+                self._open()
+            except OSError as err:
+                logging.error(f'Cannot reopen access log {self.path}: {err}')
+                self._file = sys.stderr
+        formatter = self._format_json if self.format == JSON else self._format_combined
+        try:
+            self._file.write(''.join([formatter(*record) for record in batch]))
+            self._file.flush()
+        except (OSError, ValueError) as err:
+            logging.error(f'Cannot write access log {self.path}: {err}')
+
+    def _local_time(self, timestamp):
+        second = int(timestamp)
+        cached, formatted = self._time_cache
+        if cached != second:
+            formatted = time.strftime('%d/%b/%Y:%H:%M:%S %z', time.localtime(second))
+            self._time_cache = (second, formatted)
+        return formatted
+
+    def _format_combined(self, timestamp, address, method, path, version, status, size, referer,
+                         user_agent, duration):
+        request = f'{method} {path} {version}' if method else '-'
+        return (f'{address[0]} - - [{self._local_time(timestamp)}] "{_escape(request)}" {status or "-"} '
+                f'{size or "-"} "{_escape(referer or "-")}" "{_escape(user_agent or "-")}" {duration:.6f}\n')
+
+    @staticmethod
+    def _format_json(timestamp, address, method, path, version, status, size, referer, user_agent,
+                     duration):
+        return json.dumps({
+            'time': timestamp, 'remote_addr': address[0], 'method': method, 'path': path,
+            'version': version, 'status': status, 'bytes': size, 'referer': referer,
+            'user_agent': user_agent, 'duration': round(duration, 6), 'pid': os.getpid(),
+        }) + '\n'
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"')
@@ -0,0 +1,412 @@
+import asyncio
+import logging
+import os
+import time
+
+from src.metrics import PUBLISH_INTERVAL
+from src.server import (Server, CustomHTTPHandler, HEAD, IN_MEMORY, READ_BUFSIZE, REQUEST_TIMEOUT, SEND_BATCH_SIZE,
+                        Stream)
+from src.parser import RequestParser, ParseError
+from src.proxy import AsyncUpstream, IDEMPOTENT_METHODS, ProxyError
+
+
+class _OutputWriter:
+    """File-like wfile that collects response data instead of sending it.
+
+    Data is kept as given, memoryviews of mapped files included, so that
+    bodies are not copied before they reach the transport.
+    """
+
+    def __init__(self, output):
+        self.output = output
+
+    def write(self, data):
+        self.output.append(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+class _ProxyCall:
+    """A request to forward upstream, queued in the output in place of its response."""
+    __slots__ = ('handler', 'upstream', 'head')
+
+    def __init__(self, handler, upstream, head: bytes):
+        self.handler = handler
+        self.upstream = upstream
+        self.head = head
+
+
+class _Deferred:
+    """Work too slow for the event loop, queued in the output in place of its response.
+
+    function is called in the loop's default executor; the body it returns
+    is sent like the result of send_head.
+    """
+    __slots__ = ('handler', 'function', 'args')
+
+    def __init__(self, handler, function, args):
+        self.handler = handler
+        self.function = function
+        self.args = args
+
+
+class AsyncHTTPHandler(CustomHTTPHandler):
+    """CustomHTTPHandler for a single request already parsed by AsyncServer.
+
+    The handler runs inside the event loop and never touches the socket:
+    headers and bodies are queued in self.output and written out by the
+    server coroutine, file slices are sent with loop.sendfile. request may be a
+    ParseError, which is answered with an error page. Proxied requests are
+    forwarded by the server coroutine too, which then sends the response
+    and logs the request, and so are compression and directory listings
+    missing from their caches, which run in the executor.
+    """
+
+    def __init__(self, request, address, server, requests_handled=0):
+        self.request = request
+        self.output = []
+        self.files = []
+        self._requests_before = requests_handled
+        self._pending = False
+        super().__init__(None, address, server)
+
+    def setup(self):
+        self.wfile = _OutputWriter(self.output)
+        self.requests_handled = self._requests_before
+
+    def handle(self):
+        self.handle_request()
+
+    def read_request(self):
+        if isinstance(self.request, ParseError):
+            raise self.request
+        return self.request
+
+    def send_file(self, file, offset=0, count=None):
+        if count is None:
+            count = os.fstat(file.fileno()).st_size - offset
+        self.output.append((file, offset, count))
+        self.bytes_sent += count
+
+    def close_body(self, file):
+        # Closed by AsyncServer once the output has been written
+        self.files.append(file)
+
+    def send_chunks(self, stream):
+        # Produced by AsyncServer as the transport drains
+        self.output.append(stream)
+
+    def send_proxied(self, route):
+        self.output.append(_ProxyCall(self, route.upstream, self.proxy_request_head(route)))
+        self._pending = True
+
+    def encode(self, resolved, encoding):
+        # Compressing a few MiB would stall every connection of the worker
+        self.defer(super().encode, resolved, encoding)
+
+    def render_listing(self, path, fs, fmt, url_path, etag):
+        self.defer(super().render_listing, path, fs, fmt, url_path, etag)
+
+    def defer(self, function, *args):
+        """Have function run in the executor once the responses queued before it are sent.
+
+        Like proxied requests, those of HTTP/1.0 clients are answered with
+        Connection: close, as the body may turn out to be of unknown length.
+        """
+        if self.request_version != 'HTTP/1.1':
+            self.close_connection = True
+        self.output.append(_Deferred(self, function, args))
+        self._pending = True
+
+    def log_request(self):
+        if not self._pending:
+            super().log_request()
+
+
+class AsyncServer(Server):
+    """Single-threaded asyncio engine.
+
+    Every connection is a coroutine parked on its StreamReader, so idle
+    keep-alive clients cost a few kilobytes instead of a thread each.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._loop = None
+        self._stopping = None
+        self._connections = set()
+        self._idle = set()
+        self._upstream_pools = {}
+        super().__init__(*args, **kwargs)
+
+    def serve_forever(self, poll_interval=0.5):
+        if self.access_log:
+            self.access_log.start()
+        asyncio.run(self._serve())
+        self.publish_metrics(force=True)
+        self.log_stats()
+        if self.access_log:
+            self.access_log.close()
+
+    def idle_count(self) -> int:
+        return len(self._idle)
+
+    def metrics_sample(self) -> dict:
+        sample = super().metrics_sample()
+        sample['connections_active'] = len(self._connections)
+        return sample
+
+    def shutdown(self):
+        super().shutdown()
+        if self._loop:
+            self._loop.call_soon_threadsafe(self._stopping.set)
+
+    async def _serve(self):
+        self._stopping = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        if self._shutdown_request:
+            return
+        self._socket.setblocking(False)
+        server = await asyncio.start_server(self._handle_connection, sock=self._socket)
+        publisher = asyncio.create_task(self._publish_metrics()) if self.metrics else None
+        await self._stopping.wait()
+        server.close()
+        if publisher:
+            publisher.cancel()
+        for task in self._idle:
+            task.cancel()
+        if self._connections:
+            await asyncio.wait(self._connections, timeout=self.shutdown_timeout)
+        for pool in self._upstream_pools.values():
+            pool.close()
+
+    async def _publish_metrics(self):
+        while True:
+            self.publish_metrics()
+            await asyncio.sleep(PUBLISH_INTERVAL)
+
+    async def _read_request(self, reader, parser, idle):
+        """Read the next request with the same deadlines as CustomHTTPHandler.read_request."""
+        deadline = None
+        while True:
+            request = parser.next_request()
+            if request is not None:
+                return request
+            if idle and not parser.buffer:
+                timeout = self.keepalive_timeout
+            else:
+                if deadline is None and self.timeout is not None:
+                    deadline = time.monotonic() + self.timeout
+                timeout = None if deadline is None else deadline - time.monotonic()
+            try:
+                if timeout is not None and timeout <= 0:
+                    raise TimeoutError
+                data = await asyncio.wait_for(reader.read(READ_BUFSIZE), timeout)
+            except TimeoutError:
+                if parser.buffer:
+                    raise ParseError(REQUEST_TIMEOUT)
+                raise
+            if not data:
+                return None
+            parser.feed(data)
+
+    def _write_timeout(self, size):
+        """write_timeout plus the time to send size bytes at min_transfer_rate, or None."""
+        if self.write_timeout is None:
+            return None
+        return self.write_timeout + (size / self.min_transfer_rate if self.min_transfer_rate else 0)
+
+    async def _write_output(self, writer, output, files):
+        """Write the queued output, each piece within the write timeout for its size."""
+        loop = asyncio.get_running_loop()
+        try:
+            data = []
+            for chunk in output:
+                if isinstance(chunk, IN_MEMORY):
+                    data.append(chunk)
+                    continue
+                await self._drain(writer, data)
+                data = []
+                if isinstance(chunk, Stream):
+                    await self._send_stream(writer, chunk)
+                    continue
+                if isinstance(chunk, _ProxyCall):
+                    await self._proxy(writer, chunk)
+                    continue
+                if isinstance(chunk, _Deferred):
+                    await self._run_deferred(writer, chunk)
+                    continue
+                file, offset, count = chunk
+                await asyncio.wait_for(loop.sendfile(writer.transport, file, offset, count),
+                                       self._write_timeout(count))
+            await self._drain(writer, data)
+        finally:
+            for chunk in output:
+                if isinstance(chunk, Stream):
+                    chunk.close()
+            for file in files:
+                file.close()
+            output.clear()
+            files.clear()
+
+    async def _drain(self, writer, data):
+        """Write data and wait for the transport to drain it.
+
+        Small pieces are joined into one write; pieces of SEND_BATCH_SIZE
+        and more, like mapped file bodies, are written in slices of that
+        size straight from their buffer, so that at most the unsent rest of
+        one slice is copied into the transport.
+        """
+        small = []
+        size = 0
+        for chunk in data:
+            if len(chunk) < SEND_BATCH_SIZE:
+                small.append(chunk)
+                size += len(chunk)
+                continue
+            if small:
+                writer.write(b''.join(small))
+                await asyncio.wait_for(writer.drain(), self._write_timeout(size))
+                small = []
+                size = 0
+            view = memoryview(chunk)
+            for offset in range(0, len(view), SEND_BATCH_SIZE):
+                writer.write(view[offset:offset + SEND_BATCH_SIZE])
+                await asyncio.wait_for(writer.drain(), self._write_timeout(SEND_BATCH_SIZE))
+        writer.write(b''.join(small))
+        await asyncio.wait_for(writer.drain(), self._write_timeout(size))
+
+    async def _send_stream(self, writer, stream):
+        """Produce the next chunk of stream only once the previous one has drained.
+
+        Chunks are produced in the executor, as producers like on-the-fly
+        compression may take a while. A producer that fails leaves the
+        response incomplete, so the connection is dropped.
+        """
+        loop = asyncio.get_running_loop()
+        frames = stream.frames()
+        try:
+            while (frame := await loop.run_in_executor(None, next, frames, None)) is not None:
+                await self._drain(writer, frame)
+        except OSError:
+            raise
+        except Exception:
+            logging.exception(f'{writer.get_extra_info("peername")}: streaming failed')
+            raise ConnectionAbortedError('stream producer failed')
+
+    async def _run_deferred(self, writer, call):
+        """Run deferred work in the executor, then send the response it queued."""
+        handler = call.handler
+        handler.output = []
+        handler.wfile = _OutputWriter(handler.output)
+        handler.files = []
+        try:
+            body = await asyncio.get_running_loop().run_in_executor(None, call.function, *call.args)
+            if handler.method == HEAD:
+                handler.discard_body(body)
+            elif body is not None:
+                handler.send_body(body)
+            await self._write_output(writer, handler.output, handler.files)
+        finally:
+            handler._pending = False
+            handler.log_request()
+
+    async def _proxy(self, writer, call):
+        """Forward a proxied request and stream the upstream response back as it arrives."""
+        handler = call.handler
+        pool = self._upstream_pools.get(id(call.upstream))
+        if pool is None:
+            pool = self._upstream_pools[id(call.upstream)] = AsyncUpstream(call.upstream)
+        handler.output = []
+        handler.wfile = _OutputWriter(handler.output)
+        body = None
+        try:
+            try:
+                response, body = await pool.forward(call.head, handler.request_body, handler.method == HEAD,
+                                                    handler.method in IDEMPOTENT_METHODS)
+            except ProxyError as err:
+                logging.warning(f'{handler.request_address}: {handler.method} {handler.path}: {err}')
+                handler.send_error(err.code, err.message)
+                stream = None
+            else:
+                stream = handler.send_upstream_response(response, body)
+            await self._drain(writer, handler.output)
+            if stream is None:
+                return
+            try:
+                async for data in body:
+                    frame = stream.frame([data], len(data))
+                    handler.bytes_sent += sum(len(piece) for piece in frame)
+                    await self._drain(writer, frame)
+            except ProxyError as err:
+                logging.warning(f'{handler.request_address}: {handler.method} {handler.path}: {err}')
+                raise ConnectionAbortedError('upstream response incomplete')
+            if stream.chunked:
+                await self._drain(writer, [b'0\r\n\r\n'])
+                handler.bytes_sent += 5
+        finally:
+            if body is not None:
+                body.close()
+            handler._pending = False
+            handler.log_request()
+
+    async def _handle_connection(self, reader, writer):
+        client_address = writer.get_extra_info('peername')
+        if not self.acquire_client(client_address[0]):
+            writer.write(self._unavailable_response)
+            writer.close()
+            return
+        task = asyncio.current_task()
+        self._connections.add(task)
+        parser = RequestParser(max_body_size=self.max_body_size)
+        handled = 0
+        output = []
+        files = []
+        pending = 0
+        try:
+            while not self._shutdown_request:
+                try:
+                    request = parser.next_request()
+                except ParseError as err:
+                    request = err
+                if request is None:
+                    # Responses to everything pipelined so far go out in one
+                    # batch before waiting for more data
+                    await self._write_output(writer, output, files)
+                    pending = 0
+                    self._idle.add(task)
+                    try:
+                        request = await self._read_request(reader, parser, handled and not parser.buffer)
+                    except TimeoutError:
+                        break
+                    except ParseError as err:
+                        request = err
+                    finally:
+                        self._idle.discard(task)
+                    if request is None:
+                        break
+                handler = self.handler(request, client_address, self, handled)
+                handled = handler.requests_handled
+                output.extend(handler.output)
+                files.extend(handler.files)
+                pending += handler.bytes_sent
+                if handler.close_connection:
+                    break
+                if pending >= SEND_BATCH_SIZE:
+                    await self._write_output(writer, output, files)
+                    pending = 0
+            await self._write_output(writer, output, files)
+        except ConnectionError as err:
+            logging.debug(f'{client_address}: {err}')
+        except TimeoutError:
+            # Drop what is still buffered rather than flushing it on close
+            writer.transport.abort()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            for file in files:
+                file.close()
+            self._connections.discard(task)
+            self.release_client(client_address[0])
+            writer.close()
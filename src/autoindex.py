@@ -0,0 +1,97 @@
+import datetime
+import html
+import json
+import os
+import posixpath
+import urllib.parse
+
+HTML = 'html'
+JSON = 'json'
+CONTENT_TYPES = {HTML: 'text/html; charset=utf-8', JSON: 'application/json'}
+# Entries rendered per piece of a listing; listings of more entries are
+# streamed rather than built in memory first
+RENDER_CHUNK = 1000
+DEFAULT_LISTING_CACHE_SIZE = 16 * 1024 * 1024
+
+
+class Entry:
+    __slots__ = ('name', 'is_dir', 'size', 'mtime')
+
+    def __init__(self, name: str, is_dir: bool, size: int, mtime: float):
+        self.name = name
+        self.is_dir = is_dir
+        self.size = size
+        self.mtime = mtime
+
+
+def scan(path) -> list:
+    """Entries of directory path, directories first, each group sorted by name.
+
+    Raises OSError if the directory cannot be read; entries that vanish
+    while scanning are skipped.
+    """
+    entries = []
+    with os.scandir(path) as it:
+        for dirent in it:
+            try:
+                fs = dirent.stat()
+                is_dir = dirent.is_dir()
+            except OSError:
+                continue
+            entries.append(Entry(dirent.name, is_dir, 0 if is_dir else fs.st_size, fs.st_mtime))
+    entries.sort(key=lambda entry: (not entry.is_dir, entry.name))
+    return entries
+
+
+def render(fmt, url_path: str, entries: list):
+    """Listing of entries for the directory at url_path, which ends with a slash.
+
+    Yields the listing in pieces of up to RENDER_CHUNK entries, so that a
+    large directory can be sent while it is rendered.
+    """
+    if fmt == JSON:
+        return render_json(url_path, entries)
+    return render_html(url_path, entries)
+
+
+def render_html(url_path: str, entries: list):
+    title = html.escape(f'Index of {url_path}', quote=False)
+    head = (f'<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8">\n<title>{title}</title>\n</head>\n'
+            f'<body>\n<h1>{title}</h1>\n<table>\n'
+            f'<tr><th>Name</th><th>Last modified</th><th>Size</th></tr>\n')
+    if url_path != '/':
+        parent = urllib.parse.quote(posixpath.dirname(url_path.rstrip('/')).rstrip('/') + '/',
+                                    errors='surrogateescape')
+        head += f'<tr><td><a href="{parent}">../</a></td><td></td><td></td></tr>\n'
+    yield head.encode('utf-8', 'surrogateescape')
+    for start in range(0, len(entries), RENDER_CHUNK):
+        rows = []
+        for entry in entries[start:start + RENDER_CHUNK]:
+            name = entry.name + '/' if entry.is_dir else entry.name
+            href = urllib.parse.quote(url_path + name, errors='surrogateescape')
+            modified = datetime.datetime.fromtimestamp(entry.mtime, datetime.timezone.utc)
+            modified = modified.strftime('%Y-%m-%d %H:%M')
+            size = '-' if entry.is_dir else str(entry.size)
+            rows.append(f'<tr><td><a href="{href}">{html.escape(name, quote=False)}</a></td>'
+                        f'<td>{modified}</td><td>{size}</td></tr>\n')
+        yield ''.join(rows).encode('utf-8', 'surrogateescape')
+    yield b'</table>\n</body>\n</html>\n'
+
+
+def render_json(url_path: str, entries: list):
+    yield f'{{"path": {json.dumps(url_path)}, "entries": ['.encode()
+    for start in range(0, len(entries), RENDER_CHUNK):
+        piece = ','.join(
+            json.dumps({'name': entry.name, 'type': 'directory' if entry.is_dir else 'file',
+                        'size': entry.size, 'mtime': entry.mtime})
+            for entry in entries[start:start + RENDER_CHUNK]
+        )
+        yield (',' + piece if start else piece).encode()
+    yield b']}\n'
+
+
+def wants_json(query: str, accept: str) -> bool:
+    """?format=json, or an Accept header preferring JSON, asks for a JSON listing."""
+    if query and urllib.parse.parse_qs(query).get('format') == [JSON]:
+        return True
+    return bool(accept) and accept.split(',', 1)[0].split(';', 1)[0].strip() == 'application/json'
@@ -0,0 +1,210 @@
+import mmap
+import os
+import stat
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_CACHE_SIZE = 32 * 1024 * 1024
+DEFAULT_MAX_FILE_SIZE = 256 * 1024
+DEFAULT_PATH_CACHE_ENTRIES = 10000
+DEFAULT_COMPRESS_CACHE_SIZE = 32 * 1024 * 1024
+DEFAULT_COMPRESS_MAX_FILE_SIZE = 4 * 1024 * 1024
+DEFAULT_MMAP_CACHE_SIZE = 0
+DEFAULT_MMAP_MAX_FILE_SIZE = 64 * 1024 * 1024
+PATH_TTL = 2.0
+NEGATIVE_PATH_TTL = 1.0
+
+
+class ResolvedPath:
+    """Filesystem target of a request path and the stat data served with it.
+
+    validators holds the prebuilt ETag/Last-Modified/Cache-Control/Vary
+    header lines sent with 200 and 304 responses, headers all entity
+    headers of a full identity 200 response.
+    """
+    __slots__ = ('path', 'ctype', 'size', 'mtime', 'etag', 'last_modified', 'cache_control', 'validators',
+                 'headers', 'compressible', 'variants')
+
+    def __init__(self, path: str, ctype: str, size: int, mtime: int, etag: str, last_modified: str,
+                 cache_control: bytes, validators: bytes, headers: bytes, compressible=False, variants=None):
+        self.path = path
+        self.ctype = ctype
+        self.size = size
+        self.mtime = mtime
+        self.etag = etag
+        self.last_modified = last_modified
+        self.cache_control = cache_control
+        self.validators = validators
+        self.headers = headers
+        # Whether the file may be compressed on the fly, and precompressed
+        # siblings as {encoding: (path, size, mtime)}
+        self.compressible = compressible
+        self.variants = variants or {}
+
+
+class PathCache:
+    """Bounded LRU map from raw request paths to ResolvedPath.
+
+    Missing files are cached too, as None, for a shorter time so that scans
+    for absent paths do not reach the filesystem either. Preloaded entries
+    are not rebuilt when they expire: a single stat of the file renews
+    them as long as its mtime and size are unchanged, so that the prebuilt
+    metadata the workers inherit stays in use.
+    """
+
+    def __init__(self, max_entries=DEFAULT_PATH_CACHE_ENTRIES, ttl=PATH_TTL, negative_ttl=NEGATIVE_PATH_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return (found, resolved); resolved is None for a cached miss."""
+        now = time.monotonic()
+        with self._lock:
+            item = self._entries.get(key)
+            if item is not None and item[0] >= now:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return True, item[1]
+        # The stat happens outside the lock
+        if item is not None and item[2] and self._unchanged(item[1]):
+            with self._lock:
+                self._entries[key] = (now + self.ttl, item[1], True)
+                self._entries.move_to_end(key)
+                self.hits += 1
+                self.revalidated += 1
+                return True, item[1]
+        with self._lock:
+            self.misses += 1
+        return False, None
+
+    @staticmethod
+    def _unchanged(resolved: ResolvedPath) -> bool:
+        try:
+            fs = os.stat(resolved.path)
+        except OSError:
+            return False
+        return stat.S_ISREG(fs.st_mode) and fs.st_mtime_ns == resolved.mtime and fs.st_size == resolved.size
+
+    def put(self, key, resolved, preloaded=False):
+        if self.max_entries <= 0:
+            return
+        ttl = self.ttl if resolved is not None else self.negative_ttl
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, resolved, preloaded and resolved is not None)
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses,
+                'revalidated': self.revalidated}
+
+
+class CachedFile:
+    __slots__ = ('headers', 'body', 'mtime', 'size')
+
+    def __init__(self, headers: bytes, body: bytes, mtime: int, size: int):
+        self.headers = headers
+        self.body = body
+        self.mtime = mtime
+        self.size = size
+
+
+class FileCache:
+    """Per-worker LRU cache of small files and their prebuilt headers.
+
+    Entries are validated against the mtime and size the caller got from
+    the filesystem, so edits on disk are picked up without a restart. Keys
+    are file paths, or (path, encoding) for compressed variants.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_SIZE, max_file_size=DEFAULT_MAX_FILE_SIZE):
+        self.max_bytes = max_bytes
+        self.max_file_size = min(max_file_size, max_bytes)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def accepts(self, fs: os.stat_result) -> bool:
+        return self.max_bytes > 0 and stat.S_ISREG(fs.st_mode) and fs.st_size <= self.max_file_size
+
+    def get(self, key, mtime: int, size: int):
+        """Return the entry for key if it was stored for the same mtime and size."""
+        entry = self._entries.get(key)
+        if entry is not None and (entry.mtime != mtime or entry.size != size):
+            self.discard(key)
+            entry = None
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key, mtime: int, size: int, headers: bytes, body: bytes):
+        """Store body and its headers, validated later against mtime and size."""
+        if self.max_bytes <= 0 or len(body) > self.max_file_size:
+            return
+        entry = CachedFile(headers, body, mtime, size)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old.body)
+            self._entries[key] = entry
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted.body)
+                self.evictions += 1
+
+    def discard(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.size -= len(entry.body)
+
+    def stats(self) -> dict:
+        return {
+            'entries': len(self._entries),
+            'bytes': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+class MmapCache(FileCache):
+    """Per-worker LRU of read-only memory maps of files, up to max_bytes mapped.
+
+    Bodies are memoryviews of the map, so responses and byte ranges are
+    slices written to the socket without copying. An evicted or outdated
+    map is only dropped from the cache; it is unmapped once the last
+    response still sending from it lets go of its slices.
+
+    A mapped file that is truncated in place makes later reads fault, so
+    files should be replaced by renaming a new one over them.
+    """
+
+    def accepts(self, fs: os.stat_result) -> bool:
+        return fs.st_size > 0 and super().accepts(fs)
+
+    def map(self, path, file, fs: os.stat_result, headers: bytes) -> memoryview:
+        """Map the open file and cache the map; returns the whole file as a memoryview."""
+        mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if hasattr(mapped, 'madvise'):
+            mapped.madvise(mmap.MADV_WILLNEED)
+        # The map is unmapped when the view and all slices of it are gone
+        view = memoryview(mapped)
+        self.put(path, fs.st_mtime_ns, fs.st_size, headers, view)
+        return view
@@ -0,0 +1,84 @@
+import gzip
+import zlib
+
+from src.mime import TEXT_TYPES
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+GZIP = 'gzip'
+BROTLI = 'br'
+# Server preference when the client weighs several codings equally
+ENCODINGS = (BROTLI, GZIP) if brotli else (GZIP,)
+EXTENSIONS = {BROTLI: '.br', GZIP: '.gz'}
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+MIN_SIZE = 256
+# Bytes of the source read per step when compressing while sending
+STREAM_BUFSIZE = 64 * 1024
+
+
+def is_compressible(ctype: str) -> bool:
+    ctype = ctype.split(';', 1)[0]
+    return ctype.startswith('text/') or ctype in TEXT_TYPES
+
+
+def parse_accept_encoding(header: str) -> dict:
+    """Map each content coding in an Accept-Encoding header to its q-value."""
+    weights = {}
+    for item in header.split(','):
+        coding, *params = item.split(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params:
+            name, sep, value = param.strip().partition('=')
+            if name == 'q' and sep:
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        weights[coding] = q
+    return weights
+
+
+def negotiate(header: str, available) -> str:
+    """Pick the best coding out of available for an Accept-Encoding header, or None."""
+    if not header:
+        return None
+    weights = parse_accept_encoding(header)
+    best, best_q = None, 0.0
+    for coding in available:
+        q = weights.get(coding, weights.get('*', 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    if encoding == BROTLI:
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    return gzip.compress(data, GZIP_LEVEL, mtime=0)
+
+
+def compress_file(path, encoding, bufsize=STREAM_BUFSIZE):
+    """Compress the file at path piece by piece, yielding the output as it is produced."""
+    if encoding == BROTLI:
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        process, finish = compressor.process, compressor.finish
+    else:
+        # wbits 31 writes the gzip header and trailer, with mtime 0 like compress()
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+        process, finish = compressor.compress, compressor.flush
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(bufsize)
+            if not data:
+                break
+            output = process(data)
+            if output:
+                yield output
+    yield finish()
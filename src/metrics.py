@@ -0,0 +1,146 @@
+import bisect
+import threading
+import time
+from multiprocessing.sharedctypes import RawArray
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+PUBLISH_INTERVAL = 1.0
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+METHODS = ('GET', 'HEAD', 'other')
+MIN_STATUS = 100
+MAX_STATUS = 599
+# Sampled from the server when publishing: gauges are reset when a worker
+# goes away, counters are carried over to the next worker in the slot
+GAUGES = ('connections_active', 'connections_idle', 'threads', 'threads_busy', 'connections_queued')
+COUNTERS = ('connections_rejected', 'path_cache_hits', 'path_cache_misses', 'file_cache_hits',
+            'file_cache_misses', 'compressed_cache_hits', 'compressed_cache_misses', 'mmap_cache_hits',
+            'mmap_cache_misses')
+
+_STATUS = 0
+_METHOD = _STATUS + MAX_STATUS - MIN_STATUS + 1
+_BUCKET = _METHOD + len(METHODS)
+_LATENCY_SUM = _BUCKET + len(LATENCY_BUCKETS) + 1
+_BYTES = _LATENCY_SUM + 1
+_RECORDED = _BYTES + 1
+_SAMPLED = {name: _RECORDED + i for i, name in enumerate(GAUGES + COUNTERS)}
+SLOT_SIZE = _RECORDED + len(_SAMPLED)
+
+
+class Metrics:
+    """Request counters of all workers in one shared array.
+
+    The array is created in the master before the workers are forked and
+    holds one slot per worker. A worker counts into a private list under
+    its own lock and copies it into its slot at most once per
+    PUBLISH_INTERVAL, so the hot path never touches shared memory. Any
+    worker can render the sum of all slots.
+    """
+
+    def __init__(self, slots=1):
+        self.slots = slots
+        self._shared = RawArray('d', slots * SLOT_SIZE)
+        self.slot = None
+        self._values = [0.0] * SLOT_SIZE
+        self._base = {}
+        self._lock = threading.Lock()
+        self._published = 0.0
+
+    def attach(self, slot):
+        """Start counting into slot; counters already there are continued."""
+        self.slot = slot
+        start = slot * SLOT_SIZE
+        self._values = list(self._shared[start:start + SLOT_SIZE])
+        self._base = {name: self._values[_SAMPLED[name]] for name in COUNTERS}
+        self._published = 0.0
+
+    def detach(self):
+        """Stop publishing, for a worker that got no slot; render() still sums the others."""
+        self.slot = None
+
+    def release(self, slot):
+        """Clear the gauges of a slot whose worker has exited."""
+        start = slot * SLOT_SIZE
+        for name in GAUGES:
+            self._shared[start + _SAMPLED[name]] = 0.0
+
+    def record(self, method, status, size, duration):
+        if status is None:
+            return
+        method_index = METHODS.index(method) if method in METHODS[:-1] else len(METHODS) - 1
+        bucket = bisect.bisect_left(LATENCY_BUCKETS, duration)
+        values = self._values
+        with self._lock:
+            if MIN_STATUS <= status <= MAX_STATUS:
+                values[_STATUS + status - MIN_STATUS] += 1
+            values[_METHOD + method_index] += 1
+            values[_BUCKET + bucket] += 1
+            values[_LATENCY_SUM] += duration
+            values[_BYTES] += size
+
+    def publish(self, sample=None, force=False):
+        """Copy the worker's values into its slot, at most once per PUBLISH_INTERVAL.
+
+        sample is a callable returning the current GAUGES and COUNTERS of
+        the worker as a dict.
+        """
+        now = time.monotonic()
+        if self.slot is None or (not force and now - self._published < PUBLISH_INTERVAL):
+            return
+        self._published = now
+        values = self._values
+        if sample is not None:
+            for name, value in sample().items():
+                values[_SAMPLED[name]] = value + self._base.get(name, 0.0)
+        start = self.slot * SLOT_SIZE
+        with self._lock:
+            self._shared[start:start + SLOT_SIZE] = values
+
+    def totals(self) -> list:
+        shared = self._shared
+        totals = [0.0] * SLOT_SIZE
+        for slot in range(self.slots):
+            start = slot * SLOT_SIZE
+            for i, value in enumerate(shared[start:start + SLOT_SIZE]):
+                totals[i] += value
+        return totals
+
+    def render(self) -> bytes:
+        """The summed counters of all workers in the Prometheus text format."""
+        totals = self.totals()
+        lines = [
+            '# HELP httpd_requests_total Requests by response status.',
+            '# TYPE httpd_requests_total counter',
+        ]
+        for i in range(MAX_STATUS - MIN_STATUS + 1):
+            if totals[_STATUS + i]:
+                lines.append(f'httpd_requests_total{{code="{MIN_STATUS + i}"}} {totals[_STATUS + i]:.0f}')
+        lines += [
+            '# HELP httpd_requests_by_method_total Requests by method.',
+            '# TYPE httpd_requests_by_method_total counter',
+        ]
+        for i, method in enumerate(METHODS):
+            lines.append(f'httpd_requests_by_method_total{{method="{method}"}} {totals[_METHOD + i]:.0f}')
+        lines += [
+            '# HELP httpd_request_duration_seconds Time from parsed request to response handed to the socket.',
+            '# TYPE httpd_request_duration_seconds histogram',
+        ]
+        count = 0
+        for i, bound in enumerate(LATENCY_BUCKETS + ('+Inf',)):
+            count += totals[_BUCKET + i]
+            lines.append(f'httpd_request_duration_seconds_bucket{{le="{bound}"}} {count:.0f}')
+        lines += [
+            f'httpd_request_duration_seconds_sum {totals[_LATENCY_SUM]:.6f}',
+            f'httpd_request_duration_seconds_count {count:.0f}',
+            '# HELP httpd_response_bytes_total Bytes of response headers and bodies.',
+            '# TYPE httpd_response_bytes_total counter',
+            f'httpd_response_bytes_total {totals[_BYTES]:.0f}',
+        ]
+        for name in GAUGES:
+            lines += [f'# TYPE httpd_{name} gauge', f'httpd_{name} {totals[_SAMPLED[name]]:.0f}']
+        lines += ['# TYPE httpd_connections_rejected_total counter',
+                  f'httpd_connections_rejected_total {totals[_SAMPLED["connections_rejected"]]:.0f}']
+        for cache in ('path', 'file', 'compressed', 'mmap'):
+            for kind in ('hits', 'misses'):
+                lines += [f'# TYPE httpd_{cache}_cache_{kind}_total counter',
+                          f'httpd_{cache}_cache_{kind}_total {totals[_SAMPLED[f"{cache}_cache_{kind}"]]:.0f}']
+        return ('\n'.join(lines) + '\n').encode()
@@ -0,0 +1,56 @@
+import mimetypes
+import os
+import posixpath
+
+DEFAULT_TYPE = 'application/octet-stream'
+TEXT_TYPES = ('application/javascript', 'application/json', 'application/xml', 'image/svg+xml')
+
+
+# Kept whatever the system tables say
+PREFERRED_TYPES = {'.swf': 'application/x-shockwave-flash'}
+
+
+class MimeTypes:
+    """Extension to Content-Type table built once and shared by all handlers.
+
+    Starts from Python's built-in mimetypes table extended with the system
+    tables in mimetypes.knownfiles, as mimetypes.init() would, and
+    PREFERRED_TYPES. Then mime.types style files and explicit
+    {'.ext': 'type'} overrides are applied in order. With charset set,
+    text types get a charset parameter so that browsers do not have to
+    sniff the encoding.
+    """
+
+    def __init__(self, files=(), overrides=None, charset=None):
+        db = mimetypes.MimeTypes([name for name in mimetypes.knownfiles if os.path.isfile(name)])
+        db.types_map[True].update(PREFERRED_TYPES)
+        for filename in files:
+            db.read(filename)
+        types_map = dict(db.types_map[True])
+        types_map.update(overrides or {})
+        if charset:
+            types_map = {ext: self._with_charset(ctype, charset) for ext, ctype in types_map.items()}
+        self.types_map = types_map
+
+    def guess_type(self, path) -> str:
+        base, ext = posixpath.splitext(path)
+        ctype = self.types_map.get(ext)
+        if ctype is None:
+            ctype = self.types_map.get(ext.lower(), DEFAULT_TYPE)
+        return ctype
+
+    @staticmethod
+    def _with_charset(ctype, charset):
+        if ctype.startswith('text/') or ctype in TEXT_TYPES:
+            return f'{ctype}; charset={charset}'
+        return ctype
+
+
+def parse_override(value: str) -> tuple:
+    """Parse a '.ext=type/subtype' command line override."""
+    ext, sep, ctype = value.partition('=')
+    if not sep or not ctype:
+        raise ValueError(f'expected .ext=type/subtype, got {value!r}')
+    if not ext.startswith('.'):
+        ext = '.' + ext
+    return ext, ctype
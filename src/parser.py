@@ -0,0 +1,181 @@
+import posixpath
+import urllib.parse
+
+MAX_REQUEST_LINE = 65536
+MAX_HEADER_SIZE = 65536
+MAX_HEADERS = 100
+MAX_BODY_SIZE = 1024 * 1024
+
+BAD_REQUEST = 400
+LENGTH_REQUIRED = 411
+PAYLOAD_TOO_LARGE = 413
+URI_TOO_LONG = 414
+HEADER_FIELDS_TOO_LARGE = 431
+VERSION_NOT_SUPPORTED = 505
+
+
+class ParseError(Exception):
+    def __init__(self, code, message=None):
+        super().__init__(message or str(code))
+        self.code = code
+        self.message = message
+
+
+class Request:
+    __slots__ = ('method', 'path', 'version', 'headers', 'body')
+
+    def __init__(self, method: str, path: str, version: str, headers: dict, body: bytes = b''):
+        self.method = method
+        self.path = path
+        self.version = version
+        self.headers = headers
+        self.body = body
+
+
+class RequestParser:
+    """Incremental HTTP/1.x request parser.
+
+    Data received from the socket is appended to one bytearray with feed()
+    and next_request() pops complete requests off its front, so pipelined
+    requests are returned one by one. The header block is decoded once;
+    header names are lower-cased and repeated headers are joined with ', '.
+    """
+
+    def __init__(self, max_request_line=MAX_REQUEST_LINE, max_header_size=MAX_HEADER_SIZE,
+                 max_headers=MAX_HEADERS, max_body_size=MAX_BODY_SIZE):
+        self.max_request_line = max_request_line
+        self.max_header_size = max_header_size
+        self.max_headers = max_headers
+        self.max_body_size = max_body_size
+        self.buffer = bytearray()
+        self._scanned = 0
+        self._pending = None
+        self._body_size = 0
+
+    def feed(self, data):
+        self.buffer += data
+
+    def next_request(self):
+        """Return the next complete Request, or None if more data is needed.
+
+        Raises ParseError for malformed or oversized requests; the connection
+        cannot be used after that.
+        """
+        if self._pending is None:
+            if not self._parse_head():
+                return None
+        if len(self.buffer) < self._body_size:
+            return None
+        request, self._pending = self._pending, None
+        if self._body_size:
+            request.body = bytes(self.buffer[:self._body_size])
+            del self.buffer[:self._body_size]
+            self._body_size = 0
+        return request
+
+    def _parse_head(self) -> bool:
+        buffer = self.buffer
+        # Empty lines before a request line are ignored (RFC 7230, 3.5)
+        if buffer[:1] in (b'\r', b'\n'):
+            del buffer[:len(buffer) - len(buffer.lstrip(b'\r\n'))]
+            self._scanned = 0
+
+        end, size = self._find_head_end()
+        if end < 0:
+            line_end = buffer.find(b'\n')
+            if line_end < 0:
+                if len(buffer) > self.max_request_line:
+                    raise ParseError(URI_TOO_LONG)
+                return False
+            if len(buffer[:line_end].split()) == 2:
+                # HTTP/0.9 simple request, no headers follow the request line
+                end, size = line_end, 1
+            elif line_end > self.max_request_line:
+                raise ParseError(URI_TOO_LONG)
+            elif len(buffer) > self.max_header_size:
+                raise ParseError(HEADER_FIELDS_TOO_LARGE)
+            else:
+                self._scanned = max(len(buffer) - 3, 0)
+                return False
+        if end > self.max_header_size:
+            if buffer.find(b'\n', 0, self.max_request_line + 1) < 0:
+                raise ParseError(URI_TOO_LONG)
+            raise ParseError(HEADER_FIELDS_TOO_LARGE)
+
+        lines = buffer[:end].decode('latin-1').split('\n')
+        del buffer[:end + size]
+        self._scanned = 0
+
+        if len(lines[0]) > self.max_request_line:
+            raise ParseError(URI_TOO_LONG)
+        words = lines[0].split()
+        if len(words) == 2:
+            self._pending = Request(words[0], words[1], 'HTTP/0.9', {})
+            return True
+        if len(words) != 3:
+            raise ParseError(BAD_REQUEST, 'Bad request syntax')
+        method, path, version = words
+        if not version.startswith('HTTP/'):
+            raise ParseError(BAD_REQUEST, f'Bad request version {version!r}')
+        if version != 'HTTP/1.1' and version != 'HTTP/1.0':
+            raise ParseError(VERSION_NOT_SUPPORTED)
+        if len(lines) - 1 > self.max_headers:
+            raise ParseError(HEADER_FIELDS_TOO_LARGE, 'Too many headers')
+
+        headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(':')
+            if not sep or not name or name[-1] in ' \t':
+                raise ParseError(BAD_REQUEST, 'Bad header line')
+            name = name.lower()
+            value = value.strip()
+            if name in headers:
+                value = f'{headers[name]}, {value}'
+            headers[name] = value
+
+        self._body_size = self._content_length(headers)
+        self._pending = Request(method, path, version, headers)
+        return True
+
+    def _find_head_end(self):
+        """Return (offset, terminator length) of the blank line ending the headers."""
+        buffer = self.buffer
+        start = self._scanned
+        end, size = buffer.find(b'\r\n\r\n', start), 4
+        # Bare LF line endings are tolerated, also mixed with CRLF ones; the
+        # first blank line ends the head, whatever follows it
+        limit = end if end >= 0 else len(buffer)
+        for terminator in (b'\n\n', b'\n\r\n'):
+            found = buffer.find(terminator, start, limit)
+            if found >= 0:
+                end, size, limit = found, len(terminator), found
+        return end, size
+
+    def _content_length(self, headers) -> int:
+        if 'transfer-encoding' in headers:
+            raise ParseError(LENGTH_REQUIRED, 'Chunked request bodies are not supported')
+        value = headers.get('content-length')
+        if value is None:
+            return 0
+        if not value.isdigit():
+            raise ParseError(BAD_REQUEST, 'Bad Content-Length')
+        length = int(value)
+        if length > self.max_body_size:
+            raise ParseError(PAYLOAD_TOO_LARGE)
+        return length
+
+
+def normalize_path(target: str) -> str:
+    """Decoded path of a request target with dot segments and empty segments removed.
+
+    The result always starts with a slash, also for a target that does not,
+    so that no number of .. segments climbs above it; a trailing slash is
+    kept. Whatever maps, limits or forwards requests by path matches on this.
+    """
+    path = target.split('?', 1)[0].split('#', 1)[0]
+    trailing_slash = path.rstrip().endswith('/')
+    path = posixpath.normpath('/' + urllib.parse.unquote(path, errors='surrogateescape'))
+    path = '/' + '/'.join(word for word in path.split('/') if word)
+    if trailing_slash and path != '/':
+        path += '/'
+    return path
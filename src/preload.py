@@ -0,0 +1,35 @@
+import os
+import urllib.parse
+
+INDEX_FILES = ('index.html', 'index.htm')
+
+
+def walk(root):
+    """Request paths of every file under root, and of directories with an index file.
+
+    Hidden files and directories are skipped; symlinked directories are not
+    followed.
+    """
+    for directory, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(name for name in dirnames if not name.startswith('.'))
+        relative = os.path.relpath(directory, root)
+        prefix = '/' if relative == os.curdir else '/' + relative.replace(os.sep, '/') + '/'
+        if any(index in filenames for index in INDEX_FILES):
+            yield quote(prefix)
+        for name in sorted(filenames):
+            if not name.startswith('.'):
+                yield quote(prefix + name)
+
+
+def read_manifest(path):
+    """Request paths listed in a manifest file, one per line; # starts a comment."""
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if line:
+                yield line if line.startswith('/') else '/' + line
+
+
+def quote(path: str) -> str:
+    """The request path a client sends for a filesystem path, as used for cache keys."""
+    return urllib.parse.quote(path, errors='surrogateescape')
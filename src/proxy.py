@@ -0,0 +1,518 @@
+import asyncio
+import socket
+import threading
+import time
+import urllib.parse
+
+from src.parser import normalize_path
+
+BAD_GATEWAY = 502
+SERVICE_UNAVAILABLE = 503
+GATEWAY_TIMEOUT = 504
+
+DEFAULT_CONNECT_TIMEOUT = 5.0
+DEFAULT_UPSTREAM_TIMEOUT = 60.0
+DEFAULT_MAX_UPSTREAM_CONNECTIONS = 32
+# Idle upstream connections older than this are closed rather than reused,
+# to stay below the keep-alive timeout of common backends
+UPSTREAM_IDLE_TIMEOUT = 4.0
+READ_SIZE = 64 * 1024
+MAX_HEAD_SIZE = 64 * 1024
+MAX_CHUNK_LINE = 4096
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE', 'TRACE')
+# Connection-level headers that are not forwarded in either direction
+HOP_BY_HOP = frozenset(('connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+                        'proxy-connection', 'te', 'trailer', 'transfer-encoding', 'upgrade'))
+# Set by the proxy itself on requests and responses
+REQUEST_REPLACED = frozenset(('host', 'content-length', 'x-forwarded-for', 'x-forwarded-host',
+                              'x-forwarded-proto'))
+RESPONSE_REPLACED = frozenset(('content-length', 'date', 'server'))
+
+
+class ProxyError(Exception):
+    """The upstream could not be reached or sent an unusable response."""
+
+    def __init__(self, code, message=None):
+        super().__init__(message or str(code))
+        self.code = code
+        self.message = message
+
+
+class Upstream:
+    """A backend server and the keep-alive connections of one worker to it.
+
+    Idle connections are reused last in, first out; at most
+    max_connections are open at once, further requests wait up to
+    connect_timeout for one to be released. Created in the master, the
+    pool is empty when the workers are forked.
+    """
+
+    def __init__(self, host, port, max_connections=DEFAULT_MAX_UPSTREAM_CONNECTIONS,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT, timeout=DEFAULT_UPSTREAM_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.host_header = host if port == 80 else f'{host}:{port}'
+        self.max_connections = max_connections
+        self.connect_timeout = connect_timeout
+        self.timeout = timeout
+        self.requests = 0
+        self.reused = 0
+        self.failed = 0
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_connections)
+
+    def __str__(self):
+        return f'{self.host}:{self.port}'
+
+    def acquire(self):
+        """Return (socket, whether it was reused); raises ProxyError."""
+        if not self._slots.acquire(timeout=self.connect_timeout):
+            raise ProxyError(SERVICE_UNAVAILABLE, f'Too many connections to upstream {self}')
+        now = time.monotonic()
+        with self._lock:
+            while self._idle:
+                sock, released = self._idle.pop()
+                if now - released < UPSTREAM_IDLE_TIMEOUT:
+                    self.reused += 1
+                    return sock, True
+                sock.close()
+        try:
+            sock = socket.create_connection((self.host, self.port), self.connect_timeout)
+        except TimeoutError:
+            self._slots.release()
+            raise ProxyError(GATEWAY_TIMEOUT, f'Timed out connecting to upstream {self}')
+        except OSError as err:
+            self._slots.release()
+            raise ProxyError(BAD_GATEWAY, f'Cannot connect to upstream {self}: {err.strerror or err}')
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.settimeout(self.timeout)
+        return sock, False
+
+    def release(self, sock, reuse):
+        if reuse:
+            with self._lock:
+                self._idle.append((sock, time.monotonic()))
+        else:
+            sock.close()
+        self._slots.release()
+
+    def forward(self, head: bytes, body: bytes, head_only=False, retry=True):
+        """Send a request and read the head of the response.
+
+        Returns (ResponseParser, ResponseBody). A reused connection the
+        backend has closed meanwhile fails before any response arrives;
+        with retry set the request is then sent again on a new connection.
+        """
+        self.requests += 1
+        for attempt in range(2):
+            try:
+                sock, reused = self.acquire()
+            except ProxyError:
+                self.failed += 1
+                raise
+            parser = ResponseParser(head_only)
+            try:
+                sock.sendall(head + body if body else head)
+                while not parser.parse_head():
+                    data = sock.recv(READ_SIZE)
+                    if not data:
+                        raise ConnectionResetError('upstream closed the connection')
+                    parser.feed(data)
+            except TimeoutError:
+                self.release(sock, False)
+                self.failed += 1
+                raise ProxyError(GATEWAY_TIMEOUT, f'Upstream {self} timed out')
+            except (OSError, ProxyError) as err:
+                self.release(sock, False)
+                if isinstance(err, OSError) and reused and retry and not attempt and not parser.received:
+                    continue
+                self.failed += 1
+                if isinstance(err, ProxyError):
+                    raise
+                raise ProxyError(BAD_GATEWAY, f'Upstream {self} failed: {err}')
+            return parser, ResponseBody(self, sock, parser)
+
+    def close(self):
+        with self._lock:
+            for sock, _ in self._idle:
+                sock.close()
+            self._idle.clear()
+
+    def stats(self) -> dict:
+        return {'idle': len(self._idle), 'requests': self.requests, 'reused': self.reused, 'failed': self.failed}
+
+
+class ResponseBody:
+    """Iterable over the decoded body of an upstream response.
+
+    The connection goes back to the pool once the body has been read to
+    its end, or is closed when iteration stops early; close() does the
+    same for a body that is never iterated.
+    """
+
+    def __init__(self, upstream: Upstream, sock, parser):
+        self.upstream = upstream
+        self.sock = sock
+        self.parser = parser
+
+    def __iter__(self):
+        parser = self.parser
+        try:
+            while not parser.done:
+                data = parser.read_body()
+                if data:
+                    yield data
+                elif not parser.done:
+                    received = self.sock.recv(READ_SIZE)
+                    if received:
+                        parser.feed(received)
+                    else:
+                        parser.feed_eof()
+        finally:
+            self.close()
+
+    def close(self):
+        if self.sock is not None:
+            self.upstream.release(self.sock, self.parser.reusable())
+            self.sock = None
+
+
+class AsyncUpstream:
+    """Upstream connection pool of the asyncio engine, one per Upstream and event loop."""
+
+    def __init__(self, upstream: Upstream):
+        self.upstream = upstream
+        self._idle = []
+        self._slots = asyncio.Semaphore(upstream.max_connections)
+
+    async def acquire(self):
+        upstream = self.upstream
+        try:
+            await asyncio.wait_for(self._slots.acquire(), upstream.connect_timeout)
+        except TimeoutError:
+            raise ProxyError(SERVICE_UNAVAILABLE, f'Too many connections to upstream {upstream}')
+        now = time.monotonic()
+        while self._idle:
+            reader, writer, released = self._idle.pop()
+            if now - released < UPSTREAM_IDLE_TIMEOUT and not reader.at_eof():
+                upstream.reused += 1
+                return reader, writer, True
+            writer.close()
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(upstream.host, upstream.port),
+                                                    upstream.connect_timeout)
+        except TimeoutError:
+            self._slots.release()
+            raise ProxyError(GATEWAY_TIMEOUT, f'Timed out connecting to upstream {upstream}')
+        except OSError as err:
+            self._slots.release()
+            raise ProxyError(BAD_GATEWAY, f'Cannot connect to upstream {upstream}: {err.strerror or err}')
+        writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return reader, writer, False
+
+    def release(self, reader, writer, reuse):
+        if reuse:
+            self._idle.append((reader, writer, time.monotonic()))
+        else:
+            writer.close()
+        self._slots.release()
+
+    async def forward(self, head: bytes, body: bytes, head_only=False, retry=True):
+        """Upstream.forward for the event loop; returns (ResponseParser, AsyncResponseBody)."""
+        upstream = self.upstream
+        upstream.requests += 1
+        for attempt in range(2):
+            try:
+                reader, writer, reused = await self.acquire()
+            except ProxyError:
+                upstream.failed += 1
+                raise
+            parser = ResponseParser(head_only)
+            try:
+                writer.write(head + body if body else head)
+                await asyncio.wait_for(writer.drain(), upstream.timeout)
+                while not parser.parse_head():
+                    data = await asyncio.wait_for(reader.read(READ_SIZE), upstream.timeout)
+                    if not data:
+                        raise ConnectionResetError('upstream closed the connection')
+                    parser.feed(data)
+            except TimeoutError:
+                self.release(reader, writer, False)
+                upstream.failed += 1
+                raise ProxyError(GATEWAY_TIMEOUT, f'Upstream {upstream} timed out')
+            except (OSError, ProxyError) as err:
+                self.release(reader, writer, False)
+                if isinstance(err, OSError) and reused and retry and not attempt and not parser.received:
+                    continue
+                upstream.failed += 1
+                if isinstance(err, ProxyError):
+                    raise
+                raise ProxyError(BAD_GATEWAY, f'Upstream {upstream} failed: {err}')
+            except BaseException:
+                self.release(reader, writer, False)
+                raise
+            return parser, AsyncResponseBody(self, reader, writer, parser)
+
+    def close(self):
+        for _, writer, _ in self._idle:
+            writer.close()
+        self._idle.clear()
+
+
+class AsyncResponseBody:
+    """ResponseBody for the event loop, iterated with async for."""
+
+    def __init__(self, pool: AsyncUpstream, reader, writer, parser):
+        self.pool = pool
+        self.reader = reader
+        self.writer = writer
+        self.parser = parser
+
+    async def __aiter__(self):
+        parser = self.parser
+        try:
+            while not parser.done:
+                data = parser.read_body()
+                if data:
+                    yield data
+                elif not parser.done:
+                    received = await asyncio.wait_for(self.reader.read(READ_SIZE), self.pool.upstream.timeout)
+                    if received:
+                        parser.feed(received)
+                    else:
+                        parser.feed_eof()
+        finally:
+            self.close()
+
+    def close(self):
+        if self.writer is not None:
+            self.pool.release(self.reader, self.writer, self.parser.reusable())
+            self.writer = None
+
+
+class ResponseParser:
+    """Incremental parser of one upstream response, independent of the socket.
+
+    After parse_head() has returned True, status, reason and headers are
+    set and read_body() returns the decoded body data buffered so far,
+    until done. length is the Content-Length of the body, or None when
+    it is chunked or delimited by the upstream closing the connection.
+    """
+
+    def __init__(self, head_only=False):
+        self.head_only = head_only
+        self.buffer = bytearray()
+        self.received = 0
+        self.version = None
+        self.status = None
+        self.reason = None
+        self.headers = []
+        self.length = None
+        self.chunked = False
+        self.keep_alive = False
+        self.done = False
+        self._remaining = 0
+        self._chunk_state = 'size'
+
+    def feed(self, data):
+        self.buffer += data
+        self.received += len(data)
+
+    def parse_head(self) -> bool:
+        """Parse the status line and headers once they are complete; interim 1xx responses are skipped."""
+        while True:
+            end = self.buffer.find(b'\r\n\r\n')
+            if end < 0:
+                if len(self.buffer) > MAX_HEAD_SIZE:
+                    raise ProxyError(BAD_GATEWAY, 'Upstream response head too large')
+                return False
+            lines = self.buffer[:end].decode('latin-1').split('\r\n')
+            del self.buffer[:end + 4]
+            version, _, rest = lines[0].partition(' ')
+            code, _, reason = rest.partition(' ')
+            if not version.startswith('HTTP/1.') or len(code) != 3 or not code.isdigit():
+                raise ProxyError(BAD_GATEWAY, 'Bad upstream status line')
+            status = int(code)
+            if status == 101:
+                raise ProxyError(BAD_GATEWAY, 'Upgrading upstream connections is not supported')
+            if status >= 200:
+                break
+        self.version = version
+        self.status = status
+        self.reason = reason.strip()
+        headers = []
+        for line in lines[1:]:
+            name, sep, value = line.partition(':')
+            if not sep or not name:
+                raise ProxyError(BAD_GATEWAY, 'Bad upstream header line')
+            headers.append((name.strip(), value.strip()))
+        self.headers = headers
+
+        fields = {}
+        for name, value in headers:
+            name = name.lower()
+            fields[name] = f'{fields[name]}, {value}' if name in fields else value
+        tokens = [token.strip() for token in fields.get('connection', '').lower().split(',')]
+        self.keep_alive = version == 'HTTP/1.1' and 'close' not in tokens
+        if self.head_only or status in (204, 304):
+            self.done = True
+        elif 'transfer-encoding' in fields:
+            if fields['transfer-encoding'].lower().rsplit(',', 1)[-1].strip() != 'chunked':
+                # Delimited by the upstream closing the connection
+                self.keep_alive = False
+            else:
+                self.chunked = True
+        elif 'content-length' in fields:
+            value = fields['content-length']
+            if not value.isdigit():
+                raise ProxyError(BAD_GATEWAY, 'Bad upstream Content-Length')
+            self.length = self._remaining = int(value)
+            self.done = not self.length
+        else:
+            self.keep_alive = False
+        return True
+
+    def declared_length(self):
+        """The Content-Length header of the response, also for responses without a body."""
+        for name, value in self.headers:
+            if name.lower() == 'content-length':
+                return value
+        return None
+
+    def read_body(self) -> bytes:
+        buffer = self.buffer
+        if self.chunked:
+            return self._read_chunked()
+        if self.length is None:
+            data = bytes(buffer)
+            buffer.clear()
+            return data
+        count = min(self._remaining, len(buffer))
+        data = bytes(buffer[:count])
+        del buffer[:count]
+        self._remaining -= count
+        self.done = not self._remaining
+        return data
+
+    def _read_chunked(self) -> bytes:
+        buffer = self.buffer
+        pieces = []
+        while not self.done:
+            state = self._chunk_state
+            if state == 'data':
+                count = min(self._remaining, len(buffer))
+                if not count:
+                    break
+                pieces.append(bytes(buffer[:count]))
+                del buffer[:count]
+                self._remaining -= count
+                if not self._remaining:
+                    self._chunk_state = 'end'
+                continue
+            end = buffer.find(b'\n')
+            if end < 0:
+                if len(buffer) > MAX_CHUNK_LINE:
+                    raise ProxyError(BAD_GATEWAY, 'Bad upstream chunk')
+                break
+            line = bytes(buffer[:end]).strip()
+            del buffer[:end + 1]
+            if state == 'size':
+                try:
+                    self._remaining = int(line.split(b';', 1)[0], 16)
+                except ValueError:
+                    raise ProxyError(BAD_GATEWAY, 'Bad upstream chunk size')
+                self._chunk_state = 'data' if self._remaining else 'trailer'
+            elif state == 'end':
+                if line:
+                    raise ProxyError(BAD_GATEWAY, 'Bad upstream chunk')
+                self._chunk_state = 'size'
+            elif not line:
+                # Blank line ending the trailer section
+                self.done = True
+        return b''.join(pieces)
+
+    def feed_eof(self):
+        if self.chunked or self.length is not None:
+            raise ProxyError(BAD_GATEWAY, 'Upstream closed the connection before the end of the body')
+        self.done = True
+
+    def reusable(self) -> bool:
+        return self.done and self.keep_alive and not self.buffer
+
+
+class Route:
+    """Requests whose path starts with prefix are forwarded to upstream.
+
+    With path set the prefix is replaced by it, so /api/ mapped to
+    http://backend/v1/ sends /api/users as /v1/users; without it the
+    request path is passed on as is. Routes are matched and rewritten on
+    the normalized path, so dot segments cannot reach upstream paths
+    outside the mapped one.
+    """
+    __slots__ = ('prefix', 'upstream', 'path')
+
+    def __init__(self, prefix: str, upstream: Upstream, path=None):
+        self.prefix = prefix
+        self.upstream = upstream
+        self.path = path
+
+    def target(self, url_path: str) -> str:
+        """Request target sent upstream for the client's request target url_path."""
+        query = url_path.partition('?')[2]
+        path = normalize_path(url_path)
+        if self.path is None:
+            path = quote_path(path)
+        else:
+            path = self.path + quote_path(path[len(self.prefix):])
+        return f'{path}?{query}' if query else path
+
+
+def quote_path(path: str) -> str:
+    """Percent-encode a decoded path for a request line, keeping the characters allowed in it."""
+    return urllib.parse.quote(path, safe="/:@!$&'()*+,;=", errors='surrogateescape')
+
+
+def parse_route(value: str) -> tuple:
+    """Parse a 'PREFIX=http://HOST[:PORT][/PATH]' command line proxy rule into (prefix, host, port, path)."""
+    prefix, sep, url = value.partition('=')
+    if not sep or not prefix.startswith('/'):
+        raise ValueError(f'expected /prefix=http://host:port, got {value!r}')
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme != 'http' or not parts.hostname:
+        raise ValueError(f'only http:// upstreams are supported, got {url!r}')
+    return prefix, parts.hostname, parts.port or 80, parts.path or None
+
+
+def request_head(method, target, headers: dict, body: bytes, upstream: Upstream, client_address) -> bytes:
+    """Request line and headers of a request forwarded to upstream.
+
+    Hop-by-hop headers, including any the client listed in Connection,
+    are dropped; the client's address, Host and scheme are passed on in
+    X-Forwarded-* headers.
+    """
+    connection = {token.strip() for token in headers.get('connection', '').lower().split(',')}
+    lines = [f'{method} {target} HTTP/1.1', f'Host: {upstream.host_header}']
+    for name, value in headers.items():
+        if name not in HOP_BY_HOP and name not in REQUEST_REPLACED and name not in connection:
+            lines.append(f'{name}: {value}')
+    forwarded_for = headers.get('x-forwarded-for')
+    lines.append(f'X-Forwarded-For: {forwarded_for}, {client_address}' if forwarded_for
+                 else f'X-Forwarded-For: {client_address}')
+    if 'host' in headers:
+        lines.append(f'X-Forwarded-Host: {headers["host"]}')
+    lines.append('X-Forwarded-Proto: http')
+    if body or 'content-length' in headers:
+        lines.append(f'Content-Length: {len(body)}')
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+
+def response_headers(parser: ResponseParser) -> bytes:
+    """The upstream's response headers that are passed on to the client."""
+    connection = set()
+    for name, value in parser.headers:
+        if name.lower() == 'connection':
+            connection.update(token.strip() for token in value.lower().split(','))
+    return ''.join(f'{name}: {value}\r\n' for name, value in parser.headers
+                   if name.lower() not in HOP_BY_HOP and name.lower() not in RESPONSE_REPLACED
+                   and name.lower() not in connection).encode('latin-1')
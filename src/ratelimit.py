@@ -0,0 +1,104 @@
+import math
+import multiprocessing
+import time
+from multiprocessing.sharedctypes import RawArray
+
+from src.parser import normalize_path
+
+DEFAULT_TABLE_SIZE = 65536
+# Slots a client can occupy within its group, and the number of locks the
+# groups are spread over
+WAYS = 8
+LOCK_STRIPES = 64
+_MASK = 2 ** 64 - 1
+
+
+class Rule:
+    """rate requests per second with bursts of up to burst, for paths starting with prefix."""
+    __slots__ = ('prefix', 'rate', 'burst')
+
+    def __init__(self, prefix: str, rate: float, burst: float):
+        self.prefix = prefix
+        self.rate = rate
+        self.burst = burst
+
+
+def parse_rule(value: str) -> Rule:
+    """Parse a '[PREFIX=]RATE[:BURST]' command line rate limit; the prefix defaults to /."""
+    prefix, sep, limit = value.rpartition('=')
+    if not sep:
+        prefix = '/'
+    rate, _, burst = limit.partition(':')
+    rate = float(rate)
+    burst = float(burst) if burst else max(math.ceil(rate), 1)
+    if not prefix.startswith('/') or rate <= 0 or burst < 1:
+        raise ValueError(f'expected [/prefix=]rate[:burst], got {value!r}')
+    return Rule(prefix, rate, burst)
+
+
+class RateLimiter:
+    """Token buckets per client address and rule, shared by all workers.
+
+    The buckets live in arrays created in the master before the workers
+    are forked. A bucket is found by hashing the client and rule to a
+    group of WAYS slots, so a lookup touches at most WAYS entries; when a
+    group is full the least recently used bucket in it is taken over.
+    Each group is guarded by one of LOCK_STRIPES process-shared locks, so
+    workers only wait for each other when they happen to hit the same
+    stripe at the same time.
+
+    Keys are Python hashes, which agree between the workers because they
+    are forked from the same interpreter.
+    """
+
+    def __init__(self, rules, table_size=DEFAULT_TABLE_SIZE):
+        # Longest prefix first, the most specific rule is checked first
+        self.rules = sorted(rules, key=lambda rule: len(rule.prefix), reverse=True)
+        self.groups = max(table_size // WAYS, 1)
+        size = self.groups * WAYS
+        self._keys = RawArray('Q', size)
+        # Tokens left and the time they were counted, per slot
+        self._buckets = RawArray('d', 2 * size)
+        self._locks = [multiprocessing.Lock() for _ in range(min(LOCK_STRIPES, self.groups))]
+
+    def check(self, client, url_path) -> float:
+        """Take a token from every bucket of client that applies to url_path.
+
+        Returns 0 if the request may proceed, otherwise the seconds until
+        the bucket that refused it has a token again. Buckets of broader
+        prefixes are not charged for a request a narrower one refused.
+        """
+        now = time.monotonic()
+        # Compared as translate_path resolves it, so that escaping the path or
+        # adding dot segments and slashes does not get around a limit
+        url_path = normalize_path(url_path)
+        for index, rule in enumerate(self.rules):
+            if url_path.startswith(rule.prefix):
+                wait = self._take(hash((client, index)) & _MASK or 1, rule, now)
+                if wait:
+                    return wait
+        return 0.0
+
+    def _take(self, key, rule, now) -> float:
+        group = key % self.groups
+        keys = self._keys
+        buckets = self._buckets
+        start = group * WAYS
+        with self._locks[group % len(self._locks)]:
+            victim = start
+            oldest = math.inf
+            for slot in range(start, start + WAYS):
+                found = keys[slot]
+                if found == key:
+                    tokens = min(rule.burst, buckets[2 * slot] + (now - buckets[2 * slot + 1]) * rule.rate)
+                    wait = 0.0 if tokens >= 1 else (1 - tokens) / rule.rate
+                    buckets[2 * slot] = tokens - 1 if tokens >= 1 else tokens
+                    buckets[2 * slot + 1] = now
+                    return wait
+                stamp = buckets[2 * slot + 1] if found else -math.inf
+                if stamp < oldest:
+                    victim, oldest = slot, stamp
+            keys[victim] = key
+            buckets[2 * victim] = rule.burst - 1
+            buckets[2 * victim + 1] = now
+            return 0.0
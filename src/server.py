@@ -1,37 +1,98 @@
+import contextlib
+import datetime
 import email.utils
+import functools
+import html
 import logging
-import mimetypes
+import math
 import os
-import posixpath
+import queue
 import select
-import shutil
 import socket
+import stat
 import time
-import urllib
+import uuid
 import threading
-from socketserver import _SocketWriter
+
+from src.access_log import AccessLog
+from src.cache import (FileCache, MmapCache, PathCache, ResolvedPath, DEFAULT_CACHE_SIZE, DEFAULT_MAX_FILE_SIZE,
+                       DEFAULT_PATH_CACHE_ENTRIES, DEFAULT_COMPRESS_CACHE_SIZE, DEFAULT_COMPRESS_MAX_FILE_SIZE,
+                       DEFAULT_MMAP_CACHE_SIZE, DEFAULT_MMAP_MAX_FILE_SIZE)
+from src import autoindex, compression, proxy
+from src.autoindex import DEFAULT_LISTING_CACHE_SIZE
+from src.compression import is_compressible
+from src.metrics import Metrics, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from src.mime import MimeTypes
+from src.proxy import BAD_GATEWAY, GATEWAY_TIMEOUT, IDEMPOTENT_METHODS, ProxyError
+from src.ratelimit import RateLimiter
+from src.parser import (RequestParser, ParseError, LENGTH_REQUIRED, PAYLOAD_TOO_LARGE, URI_TOO_LONG,
+                        HEADER_FIELDS_TOO_LARGE, VERSION_NOT_SUPPORTED, MAX_BODY_SIZE, normalize_path)
 
 SERVER_NAME = 'MyCustomServer 0.1'
 HTTP_VERSION = 'HTTP/1.1'
 BUFFER_SIZE = 1024
+READ_BUFSIZE = 16 * 1024
+COPY_BUFSIZE = 64 * 1024
+KEEPALIVE_TIMEOUT = 5
+MAX_KEEPALIVE_REQUESTS = 100
+MAX_IDLE_CONNECTIONS = 1000
+SEND_BATCH_SIZE = 64 * 1024
+IOV_MAX = min(os.sysconf('SC_IOV_MAX'), 1024) if hasattr(os, 'sysconf') else 16
+MSG_MORE = getattr(socket, 'MSG_MORE', 0)
+MAX_RANGES = 16
+# Bodies held in memory: cached files and slices of memory-mapped ones
+IN_MEMORY = (bytes, memoryview)
+MAX_THREADS = 128
+MAX_QUEUED_CONNECTIONS = 128
+LISTEN_BACKLOG = 1024
+RETRY_AFTER = 1
+WRITE_TIMEOUT = 30
+MIN_TRANSFER_RATE = 1024
+MAX_CONNECTIONS_PER_IP = 256
+SHUTDOWN_TIMEOUT = 10
+SENDFILE_CHUNK = 256 * 1024
+# Streamed bodies are sent in chunks of at least this size, except the last
+STREAM_CHUNK = 16 * 1024
 GET = 'GET'
 HEAD = 'HEAD'
 SUPPORTED_METHODS = (GET, HEAD)
 OK = 200
+PARTIAL_CONTENT = 206
+NOT_MODIFIED = 304
 BAD_REQUEST = 400
 FORBIDDEN = 403
 NOT_FOUND = 404
 METHOD_NOT_ALLOWED = 405
+REQUEST_TIMEOUT = 408
+RANGE_NOT_SATISFIABLE = 416
+TOO_MANY_REQUESTS = 429
 INVALID_REQUEST = 422
 INTERNAL_ERROR = 500
+SERVICE_UNAVAILABLE = 503
+# Only logged, for a request whose connection failed before a status line
+# was sent, as nginx does
+CLIENT_CLOSED_REQUEST = 499
 RESPONSE = {
     OK: 'OK',
+    PARTIAL_CONTENT: 'Partial Content',
+    NOT_MODIFIED: 'Not Modified',
     BAD_REQUEST: "Bad Request",
     FORBIDDEN: "Forbidden",
     NOT_FOUND: "Not Found",
     METHOD_NOT_ALLOWED: "Method Not Allowed",
+    REQUEST_TIMEOUT: "Request Timeout",
+    LENGTH_REQUIRED: "Length Required",
+    PAYLOAD_TOO_LARGE: "Payload Too Large",
+    URI_TOO_LONG: "URI Too Long",
+    RANGE_NOT_SATISFIABLE: "Range Not Satisfiable",
     INVALID_REQUEST: "Invalid Request",
+    TOO_MANY_REQUESTS: "Too Many Requests",
+    HEADER_FIELDS_TOO_LARGE: "Request Header Fields Too Large",
     INTERNAL_ERROR: "Internal Server Error",
+    BAD_GATEWAY: "Bad Gateway",
+    SERVICE_UNAVAILABLE: "Service Unavailable",
+    GATEWAY_TIMEOUT: "Gateway Timeout",
+    VERSION_NOT_SUPPORTED: "HTTP Version Not Supported",
 }
 
 # Default error message template
@@ -52,18 +113,342 @@ DEFAULT_ERROR_MESSAGE = """\
 </html>
 """
 
+# Status line plus Server header for every known status, the fixed start
+# of each response
+STATUS_LINES = {
+    code: f'{HTTP_VERSION} {code} {reason}\r\nServer: {SERVER_NAME}\r\n'.encode()
+    for code, reason in RESPONSE.items()
+}
+CONNECTION_CLOSE = b'Connection: close\r\n'
+
 logging.basicConfig(format='[%(asctime)s] %(levelname).1s %(message)s',
                     datefmt='%Y.%m.%d %H:%M:%S',
                     level=logging.INFO)
 
 
+_date_header = (0, b'')
+
+
+def date_header() -> bytes:
+    """The Date header line, formatted at most once per second for all connections."""
+    global _date_header
+    now = int(time.time())
+    second, header = _date_header
+    if second != now:
+        header = f'Date: {email.utils.formatdate(now, usegmt=True)}\r\n'.encode()
+        _date_header = (now, header)
+    return header
+
+
+@functools.lru_cache(maxsize=128)
+def error_page(code, message=None) -> tuple:
+    """Content headers and body of the error page for code, encoded once."""
+    body = DEFAULT_ERROR_MESSAGE % {
+        'code': code,
+        'message': html.escape(RESPONSE[code], quote=False),
+        'explain': html.escape(message or RESPONSE[code], quote=False),
+    }
+    body = body.encode('utf-8', 'replace')
+    headers = f'Content-Type: text/html;charset=utf-8\r\nContent-Length: {len(body)}\r\n'.encode()
+    return headers, body
+
+
+def parse_cache_control(value: str) -> tuple:
+    """Parse a 'PREFIX=SECONDS' command line Cache-Control rule."""
+    prefix, sep, max_age = value.rpartition('=')
+    if not sep or not prefix.startswith('/') or not max_age.isdigit():
+        raise ValueError(f'expected /prefix=seconds, got {value!r}')
+    return prefix, int(max_age)
+
+
+def parse_range(header: str, size: int):
+    """Parse a Range header into a list of (first, last) byte offsets.
+
+    Returns None for headers that are not valid byte ranges (they are
+    ignored) and an empty list when no range is satisfiable.
+    """
+    unit, sep, specs = header.partition('=')
+    if unit.strip().lower() != 'bytes' or not sep:
+        return None
+    specs = specs.split(',')
+    if len(specs) > MAX_RANGES:
+        return None
+    ranges = []
+    for spec in specs:
+        first, sep, last = spec.partition('-')
+        first, last = first.strip(), last.strip()
+        if not sep or not (first or last) or not (first or '0').isdigit() or not (last or '0').isdigit():
+            return None
+        if not first:
+            # Suffix range: the last N bytes
+            if int(last) and size:
+                ranges.append((max(size - int(last), 0), size - 1))
+            continue
+        first = int(first)
+        if last and int(last) < first:
+            return None
+        if first < size:
+            ranges.append((first, min(int(last), size - 1) if last else size - 1))
+    return ranges
+
+
+class Ranges:
+    """Byte ranges of a file or cached body to send as a 206 response.
+
+    parts holds multipart delimiters as bytes and (offset, count) pairs.
+    """
+    __slots__ = ('source', 'parts')
+
+    def __init__(self, source, parts: list):
+        self.source = source
+        self.parts = parts
+
+
+class Stream:
+    """Body produced by an iterable of bytes.
+
+    With chunked set it is sent with Transfer-Encoding: chunked, otherwise
+    as is and delimited by its Content-Length or by closing the
+    connection. Pieces smaller than min_chunk are gathered into one
+    chunk, so that a producer yielding small strings does not cost a send
+    per string.
+    """
+    __slots__ = ('chunks', 'chunked', 'min_chunk')
+
+    def __init__(self, chunks, chunked=True, min_chunk=STREAM_CHUNK):
+        self.chunks = chunks
+        self.chunked = chunked
+        self.min_chunk = min_chunk
+
+    def frames(self):
+        """Lists of buffers to send in turn; only one chunk is held at a time."""
+        pending = []
+        size = 0
+        for data in self.chunks:
+            if not data:
+                continue
+            pending.append(data)
+            size += len(data)
+            if size >= self.min_chunk:
+                yield self.frame(pending, size)
+                pending = []
+                size = 0
+        frame = self.frame(pending, size) if pending else []
+        if self.chunked:
+            frame.append(b'0\r\n\r\n')
+        if frame:
+            yield frame
+
+    def frame(self, pending, size) -> list:
+        if self.chunked:
+            return [b'%x\r\n' % size, *pending, b'\r\n']
+        return pending
+
+    def close(self):
+        close = getattr(self.chunks, 'close', None)
+        if close is not None:
+            close()
+
+
+class BatchWriter:
+    """wfile that gathers responses and sends them with as few sendmsg calls as possible.
+
+    Data is held until flush() or until SEND_BATCH_SIZE bytes are pending;
+    flush(more=True) sets MSG_MORE so that headers flushed right before a
+    sendfile share TCP segments with the file data.
+
+    With write_timeout set, sending n bytes has to finish within
+    write_timeout + n / min_rate seconds, so a client that stops reading
+    or reads a trickle cannot hold the connection indefinitely.
+    """
+
+    def __init__(self, sock, write_timeout=None, min_rate=0):
+        self._sock = sock
+        self._buffers = []
+        self._size = 0
+        self.write_timeout = write_timeout
+        self.min_rate = min_rate
+
+    def deadline(self, size):
+        """Monotonic time by which size bytes must have been sent, or None."""
+        if self.write_timeout is None:
+            return None
+        allowance = size / self.min_rate if self.min_rate else 0
+        return time.monotonic() + self.write_timeout + allowance
+
+    def wait(self, deadline):
+        """Set the socket timeout to what is left until deadline."""
+        if deadline is None:
+            return
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError('write deadline exceeded')
+        self._sock.settimeout(remaining)
+
+    def write(self, data):
+        self._buffers.append(data)
+        self._size += len(data)
+        if self._size >= SEND_BATCH_SIZE:
+            self.flush()
+        return len(data)
+
+    def flush(self, more=False):
+        buffers = self._buffers
+        flags = MSG_MORE if more else 0
+        deadline = self.deadline(self._size) if buffers else None
+        while buffers:
+            self.wait(deadline)
+            sent = self._sock.sendmsg(buffers[:IOV_MAX], (), flags)
+            done = 0
+            while done < len(buffers) and sent >= len(buffers[done]):
+                sent -= len(buffers[done])
+                done += 1
+            del buffers[:done]
+            if sent:
+                buffers[0] = memoryview(buffers[0])[sent:]
+        self._size = 0
+
+
+class ThreadPool:
+    """Bounded set of threads serving accepted connections from a bounded queue.
+
+    Threads are started on demand up to max_threads and then reused. When
+    max_queue connections are already waiting, submit() refuses instead of
+    blocking so that the accept loop can turn the client away at once.
+    """
+
+    def __init__(self, max_threads=MAX_THREADS, max_queue=MAX_QUEUED_CONNECTIONS):
+        self.max_threads = max_threads
+        self.max_queue = max(max_queue, 1)
+        self._queue = queue.Queue(self.max_queue)
+        self._threads = []
+        self._idle = 0
+        self._lock = threading.Lock()
+        self.served = 0
+        self.rejected = 0
+
+    def submit(self, func, *args) -> bool:
+        with self._lock:
+            if self._idle <= self._queue.qsize() and len(self._threads) < self.max_threads:
+                t = threading.Thread(target=self._work, daemon=True)
+                t.start()
+                self._threads.append(t)
+        try:
+            self._queue.put_nowait((func, args))
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            return False
+        return True
+
+    def _work(self):
+        while True:
+            with self._lock:
+                self._idle += 1
+            item = self._queue.get()
+            with self._lock:
+                self._idle -= 1
+                if item is None:
+                    self._threads.remove(threading.current_thread())
+                    return
+            func, args = item
+            try:
+                func(*args)
+            except Exception:
+                logging.exception('Unhandled error while serving a connection')
+            with self._lock:
+                self.served += 1
+
+    def busy(self) -> int:
+        return len(self._threads) - self._idle
+
+    def saturated(self) -> bool:
+        """True when every thread is busy, so new connections have to queue."""
+        return self.busy() >= self.max_threads
+
+    def join(self, timeout):
+        """Let the threads finish the queued connections and exit."""
+        deadline = time.monotonic() + timeout
+        threads = list(self._threads)
+        try:
+            for _ in threads:
+                self._queue.put(None, timeout=max(deadline - time.monotonic(), 0))
+        except queue.Full:
+            pass
+        for t in threads:
+            t.join(max(deadline - time.monotonic(), 0))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'threads': len(self._threads), 'busy': len(self._threads) - self._idle,
+                    'queued': self._queue.qsize(), 'max_threads': self.max_threads,
+                    'max_queue': self.max_queue, 'served': self.served, 'rejected': self.rejected}
+
+
 class Server:
-    def __init__(self, server_address: tuple, handler, document_root=None, timeout=10, connect_now=True):
+    def __init__(self, server_address: tuple, handler, document_root=None, timeout=10, connect_now=True,
+                 reuse_port=False, shutdown_timeout=SHUTDOWN_TIMEOUT, cache_size=DEFAULT_CACHE_SIZE,
+                 cache_max_file_size=DEFAULT_MAX_FILE_SIZE, path_cache_entries=DEFAULT_PATH_CACHE_ENTRIES,
+                 mime_types: MimeTypes = None, keepalive_timeout=KEEPALIVE_TIMEOUT,
+                 max_keepalive_requests=MAX_KEEPALIVE_REQUESTS, max_idle_connections=MAX_IDLE_CONNECTIONS,
+                 cache_control=(), compression=True, compress_cache_size=DEFAULT_COMPRESS_CACHE_SIZE,
+                 compress_max_file_size=DEFAULT_COMPRESS_MAX_FILE_SIZE, max_threads=MAX_THREADS,
+                 max_queued_connections=MAX_QUEUED_CONNECTIONS, backlog=LISTEN_BACKLOG, retry_after=RETRY_AFTER,
+                 access_log: AccessLog = None, metrics: Metrics = None, metrics_path=None,
+                 mmap_cache_size=DEFAULT_MMAP_CACHE_SIZE, mmap_max_file_size=DEFAULT_MMAP_MAX_FILE_SIZE,
+                 write_timeout=WRITE_TIMEOUT, min_transfer_rate=MIN_TRANSFER_RATE,
+                 max_connections_per_ip=MAX_CONNECTIONS_PER_IP, autoindex=False,
+                 listing_cache_size=DEFAULT_LISTING_CACHE_SIZE, proxy_routes=(), max_body_size=MAX_BODY_SIZE,
+                 rate_limiter: RateLimiter = None):
         self.server_address = server_address
         self.handler = handler
         self.document_root = document_root
         self.timeout = timeout
+        self.reuse_port = reuse_port
+        self.shutdown_timeout = shutdown_timeout
+        self.keepalive_timeout = keepalive_timeout
+        self.write_timeout = write_timeout
+        self.min_transfer_rate = min_transfer_rate
+        self.max_connections_per_ip = max_connections_per_ip
+        self._clients = {}
+        self._clients_lock = threading.Lock()
+        self.max_keepalive_requests = max_keepalive_requests
+        self.max_idle_connections = max_idle_connections
+        # Longest prefix first, so that the most specific rule wins
+        self.cache_control = sorted(cache_control, key=lambda rule: len(rule[0]), reverse=True)
+        self.proxy_routes = sorted(proxy_routes, key=lambda route: len(route.prefix), reverse=True)
+        self.max_body_size = max_body_size
+        self._idle_connections = 0
+        self._idle_lock = threading.Lock()
         self._socket = None
+        self._shutdown_request = False
+        self.backlog = backlog
+        self.pool = ThreadPool(max_threads, max_queued_connections)
+        # Sent as is to connections refused while the pool is saturated
+        self._unavailable_response = (STATUS_LINES[SERVICE_UNAVAILABLE] + CONNECTION_CLOSE +
+                                      f'Retry-After: {retry_after}\r\nContent-Length: 0\r\n\r\n'.encode())
+        # Connection headers of keep-alive responses, by requests remaining
+        self._keepalive_headers = [
+            f'Connection: keep-alive\r\nKeep-Alive: timeout={keepalive_timeout:g}, max={remaining}\r\n'.encode()
+            for remaining in range(max_keepalive_requests + 1)
+        ]
+        self.file_cache = FileCache(cache_size, cache_max_file_size)
+        self.path_cache = PathCache(path_cache_entries)
+        self.compression = compression
+        self.compress_max_file_size = compress_max_file_size
+        self.compressed_cache = FileCache(compress_cache_size, compress_max_file_size)
+        self.mmap_cache = MmapCache(mmap_cache_size, mmap_max_file_size)
+        self.autoindex = autoindex
+        self.listing_cache = FileCache(listing_cache_size, listing_cache_size)
+        self.mime_types = mime_types or MimeTypes()
+        self.access_log = access_log
+        self.metrics = metrics
+        if metrics:
+            # A server of its own counts into the first slot; the Master
+            # attaches each worker to a slot of its own after the fork
+            metrics.attach(0)
+        self.metrics_path = metrics_path
+        self.rate_limiter = rate_limiter
         if connect_now:
             try:
                 self.connect()
@@ -77,9 +462,14 @@ class Server:
                 self.close()
             self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self.reuse_port:
+                self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
             self._socket.bind(self.server_address)
             self.server_address = self._socket.getsockname()
-            self._socket.listen(5)
+            self._socket.listen(self.backlog)
+            # Several workers may wake up for one connection, the losers
+            # must not block in accept()
+            self._socket.setblocking(False)
             logging.info(f'Server activated on {self.server_address}')
         except socket.error as e:
             # TODO: catch this error and retry
@@ -95,7 +485,10 @@ class Server:
         return self._socket.fileno()
 
     def serve_forever(self, poll_interval=0.5):
-        while True:
+        """Serve until shutdown() is called, then wait for in-flight requests."""
+        if self.access_log:
+            self.access_log.start()
+        while not self._shutdown_request:
             try:
                 r, w, e = select.select([self], [], [], poll_interval)
                 if self in r:
@@ -103,153 +496,832 @@ class Server:
             except socket.error as err:
                 logging.error(f'{err}')
                 self._socket.close()
+            self.publish_metrics()
+        self.close()
+        self.wait_for_requests(self.shutdown_timeout)
+        self.publish_metrics(force=True)
+        self.log_stats()
+        logging.info(f'Thread pool: {self.pool.stats()}')
+        if self.access_log:
+            self.access_log.close()
+
+    def log_stats(self):
+        logging.info(f'Path cache: {self.path_cache.stats()}, file cache: {self.file_cache.stats()}, '
+                     f'compressed cache: {self.compressed_cache.stats()}, mmap cache: {self.mmap_cache.stats()}, '
+                     f'listing cache: {self.listing_cache.stats()}')
+        for upstream in self.upstreams():
+            logging.info(f'Upstream {upstream}: {upstream.stats()}')
+
+    def preload(self, url_paths, max_files=None) -> dict:
+        """Resolve url_paths into the path cache and read the files that fit into the file cache.
+
+        Meant to run in the master before the workers are forked, so that
+        they start with warm caches whose pages are shared copy-on-write.
+        Files are read until the file cache budget is spent rather than
+        evicting what was loaded first; paths that do not resolve are
+        skipped. The preloaded path cache entries are renewed with a stat
+        when they expire and the file cache entries keep their prebuilt
+        headers, both until the file changes on disk.
+        """
+        started = time.monotonic()
+        resolver = self.handler.detached(self)
+        file_cache = self.file_cache
+        paths = files = size = 0
+        for url_path in url_paths:
+            if max_files is not None and paths >= max_files:
+                break
+            resolved = resolver.resolve_path(url_path)
+            if resolved is None:
+                continue
+            paths += 1
+            self.path_cache.put(url_path, resolved, preloaded=True)
+            if (resolved.size > file_cache.max_file_size or file_cache.size + resolved.size > file_cache.max_bytes
+                    or file_cache.get(resolved.path, resolved.mtime, resolved.size) is not None):
+                continue
+            try:
+                with open(resolved.path, 'rb') as f:
+                    fs = os.fstat(f.fileno())
+                    if not file_cache.accepts(fs) or fs.st_mtime_ns != resolved.mtime:
+                        continue
+                    body = f.read()
+            except OSError:
+                continue
+            if len(body) == fs.st_size:
+                file_cache.put(resolved.path, fs.st_mtime_ns, fs.st_size, resolved.headers, body)
+                files += 1
+                size += fs.st_size
+        # Lookups made while preloading are not requests
+        self.path_cache.hits = self.path_cache.misses = 0
+        file_cache.hits = file_cache.misses = 0
+        stats = {'paths': paths, 'files': files, 'bytes': size, 'seconds': round(time.monotonic() - started, 3)}
+        logging.info(f'Preloaded {stats}')
+        return stats
+
+    def shutdown(self):
+        """Stop accepting connections; safe to call from a signal handler."""
+        self._shutdown_request = True
+
+    def wait_for_requests(self, timeout):
+        self.pool.join(timeout)
+
+    def publish_metrics(self, force=False):
+        if self.metrics:
+            self.metrics.publish(self.metrics_sample, force)
+
+    def metrics_sample(self) -> dict:
+        """Current gauges and cache counters of this worker for Metrics.publish."""
+        pool = self.pool.stats()
+        sample = {
+            'connections_active': pool['busy'],
+            'connections_idle': self.idle_count(),
+            'threads': pool['threads'],
+            'threads_busy': pool['busy'],
+            'connections_queued': pool['queued'],
+            'connections_rejected': pool['rejected'],
+        }
+        for name, cache in (('path', self.path_cache), ('file', self.file_cache),
+                            ('compressed', self.compressed_cache), ('mmap', self.mmap_cache)):
+            sample[f'{name}_cache_hits'] = cache.hits
+            sample[f'{name}_cache_misses'] = cache.misses
+        return sample
+
+    def max_age_for(self, url_path):
+        """Cache-Control max-age configured for url_path, or None."""
+        for prefix, max_age in self.cache_control:
+            if url_path.startswith(prefix):
+                return max_age
+        return None
+
+    def proxy_route(self, url_path):
+        """The Route that url_path is forwarded by, or None to serve it from the document root."""
+        url_path = normalize_path(url_path)
+        for route in self.proxy_routes:
+            if url_path.startswith(route.prefix):
+                return route
+        return None
+
+    def upstreams(self) -> list:
+        return list({id(route.upstream): route.upstream for route in self.proxy_routes}.values())
+
+    def idle_count(self) -> int:
+        """Connections currently waiting for their next keep-alive request."""
+        return self._idle_connections
+
+    def saturated(self) -> bool:
+        """Whether connections are waiting for a free thread."""
+        return self.pool.saturated()
+
+    @contextlib.contextmanager
+    def idle(self):
+        with self._idle_lock:
+            self._idle_connections += 1
+        try:
+            yield
+        finally:
+            with self._idle_lock:
+                self._idle_connections -= 1
 
     def handle_request(self):
-        request, client_address = self._socket.accept()
-        t = threading.Thread(target=self.handler, args=(request, client_address, self.document_root))
-        t.daemon = True
-        t.start()
-        logging.info('Request')
+        try:
+            request, client_address = self._socket.accept()
+        except BlockingIOError:
+            return
+        client = client_address[0]
+        if not self.acquire_client(client):
+            self.refuse(request)
+        elif not self.pool.submit(self.serve_connection, request, client_address):
+            self.release_client(client)
+            self.refuse(request)
+
+    def serve_connection(self, request, client_address):
+        try:
+            self.handler(request, client_address, self)
+        finally:
+            self.release_client(client_address[0])
+
+    def acquire_client(self, client) -> bool:
+        """Count a connection from client, False if it already has too many."""
+        if not self.max_connections_per_ip:
+            return True
+        with self._clients_lock:
+            count = self._clients.get(client, 0)
+            if count >= self.max_connections_per_ip:
+                return False
+            self._clients[client] = count + 1
+        return True
+
+    def release_client(self, client):
+        if not self.max_connections_per_ip:
+            return
+        with self._clients_lock:
+            count = self._clients.pop(client, 1) - 1
+            if count:
+                self._clients[client] = count
+
+    def refuse(self, connection):
+        """Answer 503 without reading the request and close the connection."""
+        try:
+            connection.setblocking(False)
+            connection.send(self._unavailable_response)
+        except OSError:
+            pass
+        finally:
+            connection.close()
 
 
 class CustomHTTPHandler:
-    def __init__(self, connection, address, directory):
+    def __init__(self, connection, address, server):
         self.connection = connection
         self.request_address = address
-        self.directory = directory or os.getcwd()
+        self.server = server
+        self.directory = server.document_root or os.getcwd()
 
-        self.rfile = self.connection.makefile('rb', -1)
-        self.wfile = _SocketWriter(self.connection)
+        self.parser = None
+        self.wfile = None
         self.method = None
         self.path = None
         self.request_version = None
+        self.headers = {}
+        self.request_body = b''
         self.close_connection = True
-        self.raw_request_line = b''
-        self._request_headers = {}
+        self.requests_handled = 0
+        self._read_buffer = None
         self._response_headers_buffer = []
+        self.status_code = None
+        self.bytes_sent = 0
+        self._started = 0.0
+        self.setup()
         self.handle()
 
+    @classmethod
+    def detached(cls, server):
+        """A handler without a connection, to resolve paths outside of requests."""
+        handler = cls.__new__(cls)
+        handler.server = server
+        handler.directory = server.document_root or os.getcwd()
+        handler.headers = {}
+        return handler
+
+    def setup(self):
+        self.parser = RequestParser(max_body_size=self.server.max_body_size)
+        self._read_buffer = memoryview(bytearray(READ_BUFSIZE))
+        self.wfile = BatchWriter(self.connection, self.server.write_timeout, self.server.min_transfer_rate)
+
     def handle(self):
-        self.handle_request()
-        while not self.close_connection:
+        try:
             self.handle_request()
+            while not self.close_connection and not self.server._shutdown_request:
+                self.handle_request()
+            self.wfile.flush()
+        except OSError as err:
+            logging.debug(f'{self.request_address}: {err}')
+        finally:
+            self.connection.close()
+
+    def read_request(self):
+        """Return the next request from the connection, or None at EOF.
+
+        A request has to arrive completely within server.timeout of its
+        first byte (or of the accept for a new connection), however slowly
+        it trickles in; otherwise ParseError(REQUEST_TIMEOUT) is raised.
+        """
+        timeout = self.server.timeout
+        deadline = None
+        while True:
+            request = self.parser.next_request()
+            if request is not None:
+                return request
+            # Responses to everything pipelined so far go out in one batch
+            # before blocking for more data
+            self.wfile.flush()
+            if self.requests_handled and not self.parser.buffer:
+                # Between requests the connection is idle and gets the
+                # shorter keep-alive timeout
+                self.connection.settimeout(self.server.keepalive_timeout)
+                with self.server.idle():
+                    size = self.connection.recv_into(self._read_buffer)
+            else:
+                if deadline is None and timeout is not None:
+                    deadline = time.monotonic() + timeout
+                try:
+                    if deadline is not None:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            raise TimeoutError
+                        self.connection.settimeout(remaining)
+                    size = self.connection.recv_into(self._read_buffer)
+                except TimeoutError:
+                    if self.parser.buffer:
+                        raise ParseError(REQUEST_TIMEOUT)
+                    raise
+            if not size:
+                return None
+            self.parser.feed(self._read_buffer[:size])
 
     def handle_request(self):
-        self.raw_request_line = self.rfile.readline(65537)
-        if len(self.raw_request_line) > 65536:
-            return
-        if not self.raw_request_line:
+        try:
+            request = self.read_request()
+        except ParseError as err:
+            self.method = self.path = self.request_version = None
+            self.headers = {}
+            self.request_body = b''
+            self.bytes_sent = 0
+            self._started = time.monotonic()
             self.close_connection = True
+            try:
+                self.send_error(err.code, err.message)
+            finally:
+                self.log_request()
             return
-        if not self.parse_request():
+        except (ConnectionError, TimeoutError):
+            request = None
+        if request is None:
+            self.close_connection = True
             return
+        self.process_request(request)
 
+    def process_request(self, request):
+        self.method = request.method
+        self.path = request.path
+        self.request_version = request.version
+        self.headers = request.headers
+        self.request_body = request.body
+        self.status_code = None
+        self.bytes_sent = 0
+        self._started = time.monotonic()
+        self.requests_handled += 1
+        self.close_connection = not self.should_keep_alive()
+
+        server = self.server
+        # Checked before anything touches the filesystem or an upstream
+        wait = server.rate_limiter.check(self.request_address[0], self.path) if server.rate_limiter else 0
+        route = server.proxy_route(self.path) if server.proxy_routes and not wait else None
         mname = f'do_{self.method}'
-        if not hasattr(self, mname):
-            self.send_response(METHOD_NOT_ALLOWED)
-            self.flush_headers()
-            return
-        method = getattr(self, mname)
-        method()
-        self.wfile.flush()
-
-    def parse_request(self):
-        request_lines = self.raw_request_line.decode().split('\r\n')
-        words = request_lines[0].split()
-
-        if len(words) == 3:
-            self.method, self.path, self.request_version = words
-        elif len(words) == 2:
-            self.method, self.path = words
-        elif not words:
+        try:
+            if wait:
+                self.send_error(TOO_MANY_REQUESTS, headers=[('Retry-After', str(math.ceil(wait)))])
+            elif route is not None:
+                body = self.send_proxied(route)
+                if body is not None:
+                    self.send_body(body)
+            elif not hasattr(self, mname):
+                self.send_error(METHOD_NOT_ALLOWED)
+            else:
+                getattr(self, mname)()
+        finally:
+            # Also when the client went away or missed the write deadline,
+            # with the bytes sent until then
+            self.log_request()
+
+    def log_request(self):
+        """Count the request just handled and queue its access log record."""
+        server = self.server
+        duration = time.monotonic() - self._started
+        status = self.status_code
+        if status is None:
+            status = CLIENT_CLOSED_REQUEST
+        if server.metrics:
+            server.metrics.record(self.method, status, self.bytes_sent, duration)
+        if server.access_log:
+            headers = self.headers
+            server.access_log.log(self.request_address, self.method, self.path, self.request_version,
+                                  status, self.bytes_sent, headers.get('referer'),
+                                  headers.get('user-agent'), duration)
+
+    def should_keep_alive(self) -> bool:
+        """HTTP/1.1 connections persist unless closed, HTTP/1.0 ones only on request.
+
+        Connections over the per-connection request cap, beyond the server's
+        limit on idle keep-alive connections, or served while all threads
+        are busy, are closed after the response so that they cannot starve
+        new clients.
+        """
+        tokens = [token.strip() for token in self.headers.get('connection', '').lower().split(',')]
+        if 'close' in tokens:
             return False
-        else:
-            self.send_response(BAD_REQUEST)
+        if self.request_version == 'HTTP/1.0':
+            if 'keep-alive' not in tokens:
+                return False
+        elif self.request_version != 'HTTP/1.1':
             return False
+        server = self.server
+        return (self.requests_handled < server.max_keepalive_requests and
+                server.idle_count() < server.max_idle_connections and
+                not server.saturated() and not server._shutdown_request)
 
-        self.parse_headers(self.raw_request_line)
+    def translate_path(self, path):
+        url_path = normalize_path(path)
+        # Joined onto the document root word by word, so that / maps to
+        # the root itself and not to the filesystem root
+        path = self.directory
+        for word in filter(None, url_path.split('/')):
+            path = os.path.join(path, word)
+        if url_path.endswith('/') and not path.endswith(os.path.sep):
+            path += os.path.sep
+        return path
 
-        conntype = self._request_headers.get('Connection', "")
-        if conntype.lower() == 'close':
-            self.close_connection = True
-        elif conntype.lower() == 'keep-alive':
-            self.close_connection = False
+    def resolve_path(self, url_path):
+        """Map a request path to a regular file, trying index files for directories.
 
-        return True
+        Returns a ResolvedPath or None if there is nothing to serve.
+        """
+        path = self.translate_path(url_path)
+        try:
+            fs = os.stat(path)
+            if stat.S_ISDIR(fs.st_mode):
+                for index in "index.html", "index.htm":
+                    try:
+                        index = os.path.join(path, index)
+                        fs = os.stat(index)
+                    except OSError:
+                        continue
+                    path = index
+                    break
+        except (OSError, ValueError):
+            # ValueError for paths with an embedded NUL byte
+            return None
+        if not stat.S_ISREG(fs.st_mode):
+            return None
+        return self.make_resolved(url_path, path, fs)
+
+    def make_resolved(self, url_path, path, fs: os.stat_result) -> ResolvedPath:
+        server = self.server
+        ctype = server.mime_types.guess_type(path)
+        etag = f'"{fs.st_mtime_ns:x}-{fs.st_size:x}"'
+        last_modified = email.utils.formatdate(fs.st_mtime, usegmt=True)
+        max_age = server.max_age_for(url_path)
+        cache_control = b'' if max_age is None else self.format_header('Cache-Control', f'max-age={max_age}')
 
-    def parse_headers(self, request_data: bytes):
-        request_lines = request_data.decode().split('\r\n')
-        for line in request_lines[1:]:
-            if not line:
+        compressible = variants = None
+        if server.compression:
+            compressible = (is_compressible(ctype) and
+                            compression.MIN_SIZE <= fs.st_size <= server.compress_max_file_size)
+            variants = self.find_variants(path, fs)
+        resolved = ResolvedPath(path, ctype, fs.st_size, fs.st_mtime_ns, etag, last_modified, cache_control,
+                                b'', b'', compressible, variants)
+        resolved.validators = self.validator_headers(resolved, etag)
+        resolved.headers = (self.format_header("Content-type", ctype) +
+                            self.format_header("Content-Length", str(fs.st_size)) + resolved.validators +
+                            self.format_header("Accept-Ranges", "bytes"))
+        return resolved
+
+    def validator_headers(self, resolved: ResolvedPath, etag) -> bytes:
+        headers = (self.format_header('Last-Modified', resolved.last_modified) +
+                   self.format_header('ETag', etag) + resolved.cache_control)
+        if resolved.compressible or resolved.variants:
+            headers += self.format_header('Vary', 'Accept-Encoding')
+        return headers
+
+    @staticmethod
+    def find_variants(path, fs: os.stat_result) -> dict:
+        """Precompressed siblings (page.html.gz, page.html.br) at least as new as path."""
+        variants = {}
+        for encoding in compression.ENCODINGS:
+            variant = path + compression.EXTENSIONS[encoding]
+            try:
+                vs = os.stat(variant)
+            except OSError:
                 continue
-            key, value = line.split(':')
-            self._request_headers[key] = value.strip()
+            if stat.S_ISREG(vs.st_mode) and vs.st_mtime_ns >= fs.st_mtime_ns:
+                variants[encoding] = (variant, vs.st_size, vs.st_mtime_ns)
+        return variants
 
-    def send_head(self):
-        path = self.path.split('?', 1)[0]
-        path = path.split('#', 1)[0]
+    def choose_encoding(self, resolved: ResolvedPath):
+        """Content coding to send resolved with, None for identity.
 
-        path = urllib.parse.unquote(path)
-        path = posixpath.normpath(path)
+        Range requests are always served from the identity representation.
+        """
+        if not (resolved.compressible or resolved.variants) or 'range' in self.headers:
+            return None
+        available = [encoding for encoding in compression.ENCODINGS
+                     if resolved.compressible or encoding in resolved.variants]
+        return compression.negotiate(self.headers.get('accept-encoding'), available)
 
-        words = path.split('/')
-        words = filter(None, words)
-        path = ''
-        for word in words:
-            path = os.path.join(path, word)
-        if self.path.rstrip().endswith('/'):
-            path += os.path.sep
-        path = os.path.join(self.directory, path)
+    @staticmethod
+    def variant_etag(resolved: ResolvedPath, encoding):
+        if encoding is None:
+            return resolved.etag
+        return f'{resolved.etag[:-1]}-{encoding}"'
+
+    def not_modified(self, resolved: ResolvedPath, etag) -> bool:
+        """Evaluate If-None-Match, or failing that If-Modified-Since."""
+        if_none_match = self.headers.get('if-none-match')
+        if if_none_match is not None:
+            if if_none_match.strip() == '*':
+                return True
+            tags = (tag.strip() for tag in if_none_match.split(','))
+            return any(tag.removeprefix('W/') == etag for tag in tags)
+        if_modified_since = self.headers.get('if-modified-since')
+        if not if_modified_since:
+            return False
+        if if_modified_since == resolved.last_modified:
+            return True
+        try:
+            since = email.utils.parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=datetime.timezone.utc)
+        return resolved.mtime // 1_000_000_000 <= since.timestamp()
+
+    def send_head(self):
+        """Send the response headers for a GET/HEAD request.
 
-        if not os.path.exists(path):
-            self.send_response(NOT_FOUND)
-            self.flush_headers()
+        Returns the body, either bytes from the file cache, a memoryview of
+        a mapped file, an opened file the caller has to send and close,
+        Ranges of any of those, a Stream, or None if nothing is to be sent.
+        """
+        server = self.server
+        if server.metrics_path and self.path.split('?', 1)[0] == server.metrics_path:
+            return self.send_metrics()
+        path_cache = server.path_cache
+        found, resolved = path_cache.get(self.path)
+        if not found:
+            resolved = self.resolve_path(self.path)
+            path_cache.put(self.path, resolved)
+        if resolved is None:
+            if server.autoindex:
+                return self.send_listing()
+            self.send_error(NOT_FOUND)
             return
-        if os.path.isdir(path):
-            for index in "index.html", "index.htm":
-                index = os.path.join(path, index)
-                if os.path.exists(index):
-                    path = index
-                    break
+        encoding = self.choose_encoding(resolved)
+        etag = self.variant_etag(resolved, encoding)
+        if self.not_modified(resolved, etag):
+            self.send_response(NOT_MODIFIED)
+            if encoding is None:
+                self._response_headers_buffer.append(resolved.validators)
+            else:
+                self._response_headers_buffer.append(self.validator_headers(resolved, etag))
+            self.end_headers()
+            return
+        if encoding is not None:
+            return self.send_encoded(resolved, encoding)
 
-        base, ext = posixpath.splitext(path)
-        extensions_map = mimetypes.types_map.copy()
-        ctype = 'application/octet-stream'
-        if ext in extensions_map:
-            ctype = extensions_map[ext]
+        file_cache = server.file_cache
+        cached = file_cache.get(resolved.path, resolved.mtime, resolved.size)
+        if cached is None and server.mmap_cache.max_bytes and resolved.size > file_cache.max_file_size:
+            cached = server.mmap_cache.get(resolved.path, resolved.mtime, resolved.size)
+        if cached is not None:
+            return self.send_entity(resolved, cached.body, cached.headers)
 
         try:
-            f = open(path, 'rb')
+            f = open(resolved.path, 'rb')
         except OSError:
-            self.send_response(NOT_FOUND)
-            self.flush_headers()
+            self.send_error(NOT_FOUND)
             return
 
         try:
-            self.send_response(OK)
-
-            self.send_header("Content-type", ctype)
             fs = os.fstat(f.fileno())
-            self.send_header("Content-Length", str(fs.st_size))
-            # self.send_header("Last-Modified", self.date_time_string(fs.st_mtime))
-            self.end_headers()
-            return f
+            if fs.st_mtime_ns != resolved.mtime or fs.st_size != resolved.size:
+                # Changed on disk since it was resolved
+                resolved = self.make_resolved(self.path, resolved.path, fs)
+                path_cache.put(self.path, resolved)
+            body = f
+            if file_cache.accepts(fs):
+                body = f.read()
+                f.close()
+                if len(body) == fs.st_size:
+                    file_cache.put(resolved.path, fs.st_mtime_ns, fs.st_size, resolved.headers, body)
+            elif server.mmap_cache.accepts(fs):
+                body = server.mmap_cache.map(resolved.path, f, fs, resolved.headers)
+                f.close()
+            return self.send_entity(resolved, body, resolved.headers)
         except:
             f.close()
             raise
 
+    def send_listing(self):
+        """Send a listing of the requested directory, or 404 if it is not one.
+
+        Listings are cached per directory and format and rebuilt when the
+        directory's mtime or size changes, i.e. when entries are added,
+        removed or renamed. A directory of more than RENDER_CHUNK entries
+        is streamed as it is rendered, and cached afterwards if it fits.
+        """
+        path = self.translate_path(self.path).rstrip(os.sep) or os.sep
+        try:
+            fs = os.stat(path)
+        except (OSError, ValueError):
+            fs = None
+        if fs is None or not stat.S_ISDIR(fs.st_mode):
+            self.send_error(NOT_FOUND)
+            return
+        query = self.path.partition('?')[2]
+        url_path = normalize_path(self.path).rstrip('/') + '/'
+        fmt = autoindex.JSON if autoindex.wants_json(query, self.headers.get('accept')) else autoindex.HTML
+        etag = f'"d{fs.st_mtime_ns:x}-{fs.st_size:x}-{fmt}"'
+
+        if_none_match = self.headers.get('if-none-match')
+        if if_none_match and etag in (tag.strip().removeprefix('W/') for tag in if_none_match.split(',')):
+            self.send_response(NOT_MODIFIED)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+
+        cache = self.server.listing_cache
+        key = (path, fmt)
+        cached = cache.get(key, fs.st_mtime_ns, fs.st_size)
+        if cached is not None:
+            self.send_response(OK)
+            self._response_headers_buffer.append(cached.headers)
+            self.end_headers()
+            return cached.body
+        return self.render_listing(path, fs, fmt, url_path, etag)
+
+    def render_listing(self, path, fs: os.stat_result, fmt, url_path: str, etag: str):
+        """Scan the directory at path and send its listing, cached if small enough."""
+        try:
+            entries = autoindex.scan(path)
+        except OSError:
+            self.send_error(FORBIDDEN)
+            return
+        headers = (self.format_header('Content-Type', autoindex.CONTENT_TYPES[fmt]) +
+                   self.format_header('Last-Modified', email.utils.formatdate(fs.st_mtime, usegmt=True)) +
+                   self.format_header('ETag', etag) +
+                   self.format_header('Vary', 'Accept'))
+        pieces = autoindex.render(fmt, url_path, entries)
+        key = (path, fmt)
+        if len(entries) > autoindex.RENDER_CHUNK:
+            return self.send_stream(OK, headers, self.cache_listing(key, fs, headers, pieces))
+        body = b''.join(pieces)
+        headers = self.format_header('Content-Length', str(len(body))) + headers
+        self.server.listing_cache.put(key, fs.st_mtime_ns, fs.st_size, headers, body)
+        self.send_response(OK)
+        self._response_headers_buffer.append(headers)
+        self.end_headers()
+        return body
+
+    def cache_listing(self, key, fs, headers: bytes, pieces):
+        """Pass the pieces of a streamed listing through, caching it once complete if it fits."""
+        cache = self.server.listing_cache
+        kept = []
+        size = 0
+        for piece in pieces:
+            if kept is not None:
+                size += len(piece)
+                if size <= cache.max_file_size:
+                    kept.append(piece)
+                else:
+                    kept = None
+            yield piece
+        if kept is not None:
+            body = b''.join(kept)
+            headers = self.format_header('Content-Length', str(size)) + headers
+            cache.put(key, fs.st_mtime_ns, fs.st_size, headers, body)
+
+    def send_metrics(self):
+        """Send the counters of all workers, with this worker's brought up to date."""
+        server = self.server
+        server.publish_metrics(force=True)
+        body = server.metrics.render()
+        self.send_response(OK)
+        self.send_header('Content-Type', METRICS_CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        return body
+
+    def send_encoded(self, resolved: ResolvedPath, encoding):
+        """Send the compressed representation of resolved.
+
+        A precompressed sibling is used when there is one, otherwise the
+        file is compressed once; the result is kept in the compressed
+        cache until the file or its sibling changes. With the compressed
+        cache disabled the file is compressed while it is sent, chunked.
+        """
+        cache = self.server.compressed_cache
+        variant = resolved.variants.get(encoding)
+        path, size, mtime = variant or (resolved.path, resolved.size, resolved.mtime)
+        key = (resolved.path, encoding)
+        cached = cache.get(key, mtime, size)
+        if cached is None:
+            return self.encode(resolved, encoding)
+        self.send_response(OK)
+        self._response_headers_buffer.append(cached.headers)
+        self.end_headers()
+        return cached.body
+
+    def encode(self, resolved: ResolvedPath, encoding):
+        """Send the compressed representation of resolved missing from the compressed cache."""
+        cache = self.server.compressed_cache
+        variant = resolved.variants.get(encoding)
+        path, size, mtime = variant or (resolved.path, resolved.size, resolved.mtime)
+        if not variant and not cache.max_bytes:
+            # Nowhere to keep the result, compress while sending
+            headers = (self.format_header('Content-type', resolved.ctype) +
+                       self.format_header('Content-Encoding', encoding) +
+                       self.validator_headers(resolved, self.variant_etag(resolved, encoding)))
+            return self.send_stream(OK, headers, compression.compress_file(path, encoding))
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            self.send_error(NOT_FOUND)
+            return
+        if variant and size > cache.max_file_size:
+            # Too big to keep in memory, send the sibling from disk
+            body = f
+            length = size
+        else:
+            with f:
+                body = f.read()
+            if not variant:
+                body = compression.compress(body, encoding)
+            length = len(body)
+        headers = (self.format_header('Content-type', resolved.ctype) +
+                   self.format_header('Content-Length', str(length)) +
+                   self.format_header('Content-Encoding', encoding) +
+                   self.validator_headers(resolved, self.variant_etag(resolved, encoding)))
+        if isinstance(body, bytes):
+            cache.put((resolved.path, encoding), mtime, size, headers, body)
+        self.send_response(OK)
+        self._response_headers_buffer.append(headers)
+        self.end_headers()
+        return body
+
+    def send_entity(self, resolved: ResolvedPath, body, headers: bytes):
+        """Send headers for the whole body, or for the requested byte ranges of it."""
+        ranges = self.requested_ranges(resolved)
+        if ranges is None:
+            self.send_response(OK)
+            self._response_headers_buffer.append(headers)
+            self.end_headers()
+            return body
+        if not ranges:
+            if not isinstance(body, IN_MEMORY):
+                body.close()
+            self.send_error(RANGE_NOT_SATISFIABLE, headers=[('Content-Range', f'bytes */{resolved.size}')])
+            return
+
+        self.send_response(PARTIAL_CONTENT)
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            parts = [(start, end - start + 1)]
+            self.send_header('Content-type', resolved.ctype)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{resolved.size}')
+            length = end - start + 1
+        else:
+            boundary = uuid.uuid4().hex
+            parts = []
+            for start, end in ranges:
+                parts.append(f'\r\n--{boundary}\r\n'
+                             f'Content-type: {resolved.ctype}\r\n'
+                             f'Content-Range: bytes {start}-{end}/{resolved.size}\r\n\r\n'.encode())
+                parts.append((start, end - start + 1))
+            parts.append(f'\r\n--{boundary}--\r\n'.encode())
+            self.send_header('Content-type', f'multipart/byteranges; boundary={boundary}')
+            length = sum(part[1] if isinstance(part, tuple) else len(part) for part in parts)
+        self.send_header('Content-Length', str(length))
+        self._response_headers_buffer.append(resolved.validators)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+        return Ranges(body, parts)
+
+    def send_stream(self, code, headers: bytes, chunks, length=None, message=None, min_chunk=STREAM_CHUNK):
+        """Send the headers of a response whose body is produced by the iterable chunks.
+
+        headers are the entity headers without Content-Length. Returns a
+        Stream for send_body: a body of known length is sent as is,
+        otherwise chunked to HTTP/1.1 clients, and to HTTP/1.0 ones
+        followed by closing the connection.
+        """
+        chunked = length is None and self.request_version == 'HTTP/1.1'
+        if length is None and not chunked:
+            self.close_connection = True
+        self.send_response(code, message)
+        self._response_headers_buffer.append(headers)
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        elif length is not None:
+            self.send_header('Content-Length', str(length))
+        self.end_headers()
+        return Stream(chunks, chunked, min_chunk)
+
+    def send_proxied(self, route):
+        """Forward the request to the route's upstream and send the response head.
+
+        Returns the body as a Stream read from the upstream connection as
+        it is sent, or None. Requests of HTTP/1.0 clients are answered
+        with Connection: close.
+        """
+        head = self.proxy_request_head(route)
+        try:
+            response, body = route.upstream.forward(head, self.request_body, self.method == HEAD,
+                                                    self.method in IDEMPOTENT_METHODS)
+        except ProxyError as err:
+            logging.warning(f'{self.request_address}: {self.method} {self.path}: {err}')
+            self.send_error(err.code, err.message)
+            return
+        return self.send_upstream_response(response, body)
+
+    def proxy_request_head(self, route) -> bytes:
+        if self.request_version != 'HTTP/1.1':
+            self.close_connection = True
+        return proxy.request_head(self.method, route.target(self.path), self.headers, self.request_body,
+                                  route.upstream, self.request_address[0])
+
+    def send_upstream_response(self, response, body):
+        """Send the head of an upstream response; returns its body as a Stream or None."""
+        message = None if response.status in RESPONSE else response.reason or 'Unknown'
+        headers = proxy.response_headers(response)
+        if response.done:
+            body.close()
+            self.send_response(response.status, message)
+            self._response_headers_buffer.append(headers)
+            length = response.declared_length()
+            if length is not None and response.status != 204:
+                self.send_header('Content-Length', length)
+            self.end_headers()
+            return
+        # Passed on as it arrives, for backends that stream events
+        return self.send_stream(response.status, headers, body, response.length, message, min_chunk=0)
+
+    def requested_ranges(self, resolved: ResolvedPath):
+        """Ranges to serve as (first, last) byte offsets.
+
+        None means the whole entity: no usable Range header, or an If-Range
+        that no longer matches. An empty list means nothing is satisfiable.
+        """
+        header = self.headers.get('range')
+        if not header or self.method not in SUPPORTED_METHODS:
+            return None
+        if_range = self.headers.get('if-range')
+        if if_range is not None and if_range != resolved.etag and if_range != resolved.last_modified:
+            return None
+        return parse_range(header, resolved.size)
+
+    def send_error(self, code, message=None, headers=()):
+        """Send an error page built from DEFAULT_ERROR_MESSAGE."""
+        content_headers, body = error_page(code, message)
+        self.send_response(code)
+        self._response_headers_buffer.append(content_headers)
+        for keyword, value in headers:
+            self.send_header(keyword, value)
+        self.end_headers()
+        if self.method != HEAD:
+            self.wfile.write(body)
+            self.bytes_sent += len(body)
+
     def send_response(self, code, message=None):
-        if message is None:
-            message = RESPONSE[code]
-        response = "{} {} {}\r\n".format(HTTP_VERSION, code, message)
-        self._response_headers_buffer.append(response.encode('latin-1', 'strict'))
+        self.status_code = code
+        status_line = STATUS_LINES.get(code) if message is None else None
+        if status_line is None:
+            status_line = (f'{HTTP_VERSION} {code} {message or RESPONSE[code]}\r\n'
+                           f'Server: {SERVER_NAME}\r\n').encode('latin-1', 'strict')
+        buffer = self._response_headers_buffer
+        buffer.append(status_line)
+        buffer.append(date_header())
+        if self.close_connection:
+            buffer.append(CONNECTION_CLOSE)
+        else:
+            server = self.server
+            buffer.append(server._keepalive_headers[server.max_keepalive_requests - self.requests_handled])
 
-        self.send_header('Server', SERVER_NAME)
-        self.send_header('Date', email.utils.formatdate(time.time(), usegmt=True))
+    @staticmethod
+    def format_header(keyword, value) -> bytes:
+        return f'{keyword}: {value}\r\n'.encode()
 
     def send_header(self, keyword, value):
-        line = f'{keyword}: {value}\r\n'.encode()
-        self._response_headers_buffer.append(line)
+        self._response_headers_buffer.append(self.format_header(keyword, value))
 
     def end_headers(self):
         """Send the blank line ending the MIME headers."""
@@ -257,20 +1329,132 @@ class CustomHTTPHandler:
         self.flush_headers()
 
     def flush_headers(self):
-        self.wfile.write(b"".join(self._response_headers_buffer))
+        data = b"".join(self._response_headers_buffer)
+        self.wfile.write(data)
+        self.bytes_sent += len(data)
         self._response_headers_buffer = []
 
-    def do_GET(self):
-        file = self.send_head()
-        if not file:
+    def send_file(self, file, offset=0, count=None):
+        """Send count bytes of file starting at offset, up to EOF if count is None.
+
+        Regular files are handed to the kernel with os.sendfile; anything
+        else is copied through the socket writer. The caller closes the file.
+        """
+        fs = os.fstat(file.fileno())
+        if stat.S_ISREG(fs.st_mode):
+            self.wfile.flush(more=True)
+            if count is None:
+                count = fs.st_size - offset
+            if self.wfile.write_timeout is None:
+                self.bytes_sent += self.connection.sendfile(file, offset, count)
+            else:
+                self.sendfile_with_deadline(file, offset, count)
             return
+        if offset:
+            file.seek(offset)
+        while count is None or count > 0:
+            data = file.read(COPY_BUFSIZE if count is None else min(count, COPY_BUFSIZE))
+            if not data:
+                break
+            self.wfile.write(data)
+            self.bytes_sent += len(data)
+            if count is not None:
+                count -= len(data)
+
+    def sendfile_with_deadline(self, file, offset, count):
+        """os.sendfile loop that gives up once the write deadline has passed.
+
+        socket.sendfile only times out when a single wait for the socket
+        exceeds its timeout, which a client reading a trickle never causes.
+        """
+        deadline = self.wfile.deadline(count)
+        out_fd = self.connection.fileno()
+        in_fd = file.fileno()
+        while count > 0:
+            self.wfile.wait(deadline)
+            try:
+                sent = os.sendfile(out_fd, in_fd, offset, min(count, SENDFILE_CHUNK))
+            except BlockingIOError:
+                remaining = max(deadline - time.monotonic(), 0)
+                if not select.select([], [out_fd], [], remaining)[1]:
+                    raise TimeoutError('write deadline exceeded')
+                continue
+            if not sent:
+                # Truncated since the headers went out
+                break
+            offset += sent
+            count -= sent
+            self.bytes_sent += sent
+
+    def close_body(self, file):
+        file.close()
+
+    def send_body(self, body):
+        if isinstance(body, Ranges):
+            self.send_ranges(body)
+        elif isinstance(body, Stream):
+            self.send_chunks(body)
+        elif isinstance(body, IN_MEMORY):
+            self.wfile.write(body)
+            self.bytes_sent += len(body)
+        else:
+            try:
+                self.send_file(body)
+            finally:
+                self.close_body(body)
+
+    def send_chunks(self, stream):
+        """Send a Stream, flushing every chunk before the next one is produced.
+
+        The blocking send is the backpressure: a slow client holds up the
+        producer rather than letting output pile up in memory. If the
+        producer fails the response cannot be completed and the connection
+        is closed.
+        """
+        try:
+            for frame in stream.frames():
+                for data in frame:
+                    self.wfile.write(data)
+                    self.bytes_sent += len(data)
+                self.wfile.flush()
+        except OSError:
+            raise
+        except Exception:
+            logging.exception(f'{self.request_address}: streaming {self.path} failed')
+            self.close_connection = True
+        finally:
+            stream.close()
+
+    def send_ranges(self, ranges):
+        source = ranges.source
         try:
-            shutil.copyfileobj(file, self.wfile)
+            for part in ranges.parts:
+                if isinstance(part, bytes):
+                    self.wfile.write(part)
+                    self.bytes_sent += len(part)
+                    continue
+                offset, count = part
+                if isinstance(source, IN_MEMORY):
+                    self.wfile.write(memoryview(source)[offset:offset + count])
+                    self.bytes_sent += count
+                else:
+                    self.send_file(source, offset, count)
         finally:
-            file.close()
+            if not isinstance(source, IN_MEMORY):
+                self.close_body(source)
+
+    def do_GET(self):
+        body = self.send_head()
+        if body is not None:
+            self.send_body(body)
 
     def do_HEAD(self):
         """Serve a HEAD request."""
-        file = self.send_head()
-        if file:
-            file.close()
+        self.discard_body(self.send_head())
+
+    def discard_body(self, body):
+        """Release the body of a response sent without it."""
+        if isinstance(body, Ranges):
+            body = body.source
+        if body is not None and not isinstance(body, IN_MEMORY):
+            body.close()